@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+データの取得方法や描画方法ごとに，処理時間とメモリ使用量を比較します．
+
+Usage:
+  benchmark.py [-c CONFIG] fetch [-n COUNT]
+  benchmark.py [-c CONFIG] draw [-n COUNT]
+  benchmark.py [-c CONFIG] reuse [-n COUNT]
+
+Options:
+  -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
+  -n COUNT     : 比較時に処理を繰り返す回数 [default: 5]
+
+Commands:
+  fetch        : InfluxDB のクエリ結果を query と query_csv で取得する場合を比較します．
+  draw         : グラフを matplotlib と raster で描画する場合を比較します．
+  reuse        : matplotlib の Figure を使い回す場合と毎回作り直す場合を比較します．
+"""
+
+from docopt import docopt
+
+import logging
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from config import load_config, get_db_config
+
+
+def measure(func, count):
+    # NOTE: 初回はフォントの読み込み等を伴うので，計測から除く
+    func()
+
+    start = time.perf_counter()
+    for i in range(count):
+        func()
+    elapsed = (time.perf_counter() - start) / count
+
+    # NOTE: tracemalloc を有効にすると遅くなるので，時間の計測とは別に行う
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "time": elapsed,
+        "peak": peak / 1024.0 / 1024,
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def measure_worker(create_func, args, count, queue):
+    queue.put(measure(create_func(*args), count))
+
+
+# NOTE: 最大 RSS を比較できるように，方法ごとに別プロセスで計測する
+def measure_isolated(create_func, args, count):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=measure_worker, args=(create_func, args, count, queue)
+    )
+    proc.start()
+    result = queue.get()
+    proc.join()
+
+    return result
+
+
+def log_result(name, unit, result):
+    logging.info(
+        (
+            "{name}: {time:.3f} sec/{unit}, peak allocation: {peak:.1f} MB, "
+            + "max RSS: {rss:.1f} MB"
+        ).format(name=name, unit=unit, **result)
+    )
+
+
+def get_frame_data(config):
+    import sensor_graph
+    from frame_data import fetch_job_map
+
+    db_config = get_db_config(config)
+
+    return fetch_job_map(
+        sensor_graph.get_fetch_job_map(config["GRAPH"], db_config),
+        db_config["concurrency"],
+    )
+
+
+def create_fetch(config, stream):
+    from sensor_data import fetch_data_multi
+
+    graph_config = config["GRAPH"]
+    hostname_list = list(
+        dict.fromkeys(equip["HOST"] for equip in graph_config["EQUIP_LIST"])
+    )
+
+    return lambda: fetch_data_multi(
+        get_db_config(config),
+        graph_config["EQUIP_LIST"][0]["TYPE"],
+        hostname_list,
+        graph_config["PARAM"]["NAME"],
+        graph_config["PARAM"]["PERIOD"],
+        stream=stream,
+    )
+
+
+def create_draw(config, backend, reuse=True):
+    import functools
+
+    if backend == "raster":
+        from raster_graph import draw_sensor_graph
+    else:
+        import sensor_graph
+
+        draw_sensor_graph = functools.partial(
+            sensor_graph.draw_sensor_graph, reuse=reuse
+        )
+
+    frame_data = get_frame_data(config)
+
+    def draw():
+        # NOTE: PNG の場合は読み込みが遅延されるので，画素を確定させるところまで計測する
+        draw_sensor_graph(config["GRAPH"], frame_data, config["FONT"])[0].load()
+
+    return draw
+
+
+def benchmark_fetch(config, count):
+    for stream in [False, True]:
+        log_result(
+            "query_csv" if stream else "query",
+            "query",
+            measure_isolated(create_fetch, (config, stream), count),
+        )
+
+
+def benchmark_draw(config, count):
+    for backend in ["matplotlib", "raster"]:
+        log_result(
+            backend, "frame", measure_isolated(create_draw, (config, backend), count)
+        )
+
+
+def benchmark_reuse(config, count):
+    for reuse in [False, True]:
+        log_result(
+            "reuse" if reuse else "recreate",
+            "frame",
+            measure_isolated(create_draw, (config, "matplotlib", reuse), count),
+        )
+
+
+if __name__ == "__main__":
+    import logger
+
+    args = docopt(__doc__)
+
+    logger.init("test", logging.INFO)
+
+    config = load_config(args["-c"])
+    count = int(args["-n"])
+
+    if args["fetch"]:
+        benchmark_fetch(config, count)
+    elif args["draw"]:
+        benchmark_draw(config, count)
+    else:
+        benchmark_reuse(config, count)
@@ -7,6 +7,9 @@ import os
 
 CONFIG_PATH = "config.yaml"
 
+# NOTE: InfluxDB に同時に発行するクエリの数
+DB_CONCURRENCY = 4
+
 
 def abs_path(config_path=CONFIG_PATH):
     return pathlib.Path(os.getcwd(), config_path)
@@ -20,6 +23,7 @@ def get_db_config(config):
             "bucket": config["INFLUXDB"]["BUCKET"],
             "url": config["INFLUXDB"]["URL"],
             "org": config["INFLUXDB"]["ORG"],
+            "concurrency": config["INFLUXDB"].get("CONCURRENCY", DB_CONCURRENCY),
         }
     else:
         return {
@@ -27,9 +31,17 @@ def get_db_config(config):
             "bucket": config["influxdb"]["bucket"],
             "url": config["influxdb"]["url"],
             "org": config["influxdb"]["org"],
+            "concurrency": config["influxdb"].get("concurrency", DB_CONCURRENCY),
         }
 
 
+# NOTE: フォントの大きさや描画位置は PANEL.DEVICE の大きさ向けの値なので，
+# 異なる大きさで描画する場合はこの倍率を掛ける．(create_image.py の
+# get_layout_config が PANEL.DEVICE, GRAPH, USAGE に設定する)
+def get_layout_scale(layout_config):
+    return layout_config.get("SCALE", 1.0)
+
+
 def load_config(config_path=CONFIG_PATH):
     path = str(abs_path(config_path))
     with open(path, "r") as file:
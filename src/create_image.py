@@ -4,28 +4,53 @@
 電子ペーパ表示用の画像を生成します．
 
 Usage:
-  create_image.py [-c CONFIG] [-o PNG_FILE]
+  create_image.py [-c CONFIG] [-o PNG_FILE] [-f FORMAT] [-d DITHER] [-t TIME] [-s SIZE]
 
 Options:
   -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
   -o PNG_FILE  : 生成した画像を指定されたパスに保存します．
+  -f FORMAT    : 出力形式 (png, png4, raw)．指定しない場合は設定ファイルに従います．
+                 raw の場合は，詰めた 4bpp (0 が白) で出力します．
+  -d DITHER    : 16 階調に量子化する際のディザ (none, ordered, floyd_steinberg)．
+                 指定しない場合は設定ファイルに従います．
+  -t TIME      : 画像に表示する時刻 (ISO 8601 形式のローカル時刻)．
+                 指定しない場合は現在時刻を表示します．
+  -s SIZE      : 画像の大きさ (WIDTHxHEIGHT)．指定しない場合は PANEL.DEVICE に従います．
 """
 
 from docopt import docopt
 
+import copy
+import datetime
 import sys
 import PIL.Image
+import PIL.ImageDraw
 import logging
 import traceback
 import textwrap
 import notify_slack
 
 import logger
-from sensor_graph import draw_sensor_graph
+import sensor_graph
+import raster_graph
 
-from usage_panel import draw_usage_panel
-from pil_util import draw_text, get_font, convert_to_gray
-from config import load_config, get_db_config
+from usage_panel import draw_usage_panel, draw_usage_panel_base
+from frame_data import fetch_frame_data
+from pil_util import draw_text, get_font, convert_to_gray, quantize_gray, encode_gray
+from config import load_config, get_db_config, get_layout_scale
+
+# NOTE: 使われてなさそうな値にしておく．
+# display_image.py と合わせる必要あり．
+ERROR_STATUS = 222
+
+# NOTE: これより小さく縮小すると，文字が潰れて読めなくなる
+LAYOUT_SCALE_MIN = 0.5
+
+# NOTE: GRAPH.BACKEND でグラフの描画方法を選択する
+GRAPH_BACKEND_MAP = {
+    "matplotlib": sensor_graph.draw_sensor_graph,
+    "raster": raster_graph.draw_sensor_graph,
+}
 
 
 def notify_error(config, message):
@@ -38,43 +63,34 @@ def notify_error(config, message):
     )
 
 
-######################################################################
-args = docopt(__doc__)
-
-logger.init("panel.kindle.power", level=logging.INFO)
-
-logging.info("Start to create image")
-
-config_file = args["-c"]
-
-logging.info("Using config config: {config_file}".format(config_file=config_file))
-config = load_config(config_file)
-
-img = PIL.Image.new(
-    "RGBA",
-    (config["PANEL"]["DEVICE"]["WIDTH"], config["PANEL"]["DEVICE"]["HEIGHT"]),
-    (255, 255, 255, 255),
-)
-
-status = 0
-try:
+def draw_panel(config, img, frame_data, now=None):
+    draw_sensor_graph = GRAPH_BACKEND_MAP[config["GRAPH"].get("BACKEND", "matplotlib")]
     sensor_graph_img, sub_plot_height = draw_sensor_graph(
-        config["GRAPH"], get_db_config(config), config["FONT"]
+        config["GRAPH"], frame_data, config["FONT"]
     )
-    usage_panel_img = draw_usage_panel(
+    usage_panel_base_img = draw_usage_panel_base(
         config["USAGE"],
-        get_db_config(config),
         config["GRAPH"]["EQUIP_LIST"],
         config["GRAPH"]["OFFSET"],
         sub_plot_height,
-        config["FONT"],
         config["ICON"],
     )
+    usage_panel_img = draw_usage_panel(
+        config["USAGE"],
+        frame_data,
+        config["GRAPH"]["OFFSET"],
+        config["FONT"],
+        usage_panel_base_img,
+        now,
+    )
 
     img.paste(sensor_graph_img, (0, config["GRAPH"]["OFFSET"]))
     img.alpha_composite(usage_panel_img, (0, 0))
 
-except:
+
+def draw_error(config, img):
+    scale = get_layout_scale(config["PANEL"]["DEVICE"])
+
     draw = PIL.ImageDraw.Draw(img)
     draw.rectangle(
         (0, 0, config["PANEL"]["DEVICE"]["WIDTH"], config["PANEL"]["DEVICE"]["HEIGHT"]),
@@ -84,8 +100,8 @@ except:
     draw_text(
         img,
         "ERROR",
-        (10, 40),
-        get_font(config["FONT"], "EN_BOLD", 160),
+        (int(10 * scale), int(40 * scale)),
+        get_font(config["FONT"], "EN_BOLD", int(160 * scale)),
         "left",
         "#666",
     )
@@ -93,24 +109,166 @@ except:
     draw_text(
         img,
         "\n".join(textwrap.wrap(traceback.format_exc(), 60)),
-        (20, 180),
-        get_font(config["FONT"], "EN_MEDIUM", 36),
+        (int(20 * scale), int(180 * scale)),
+        get_font(config["FONT"], "EN_MEDIUM", int(36 * scale)),
         "left" "#333",
     )
     if "SLACK" in config:
         notify_error(config, traceback.format_exc())
 
     print(traceback.format_exc(), file=sys.stderr)
-    # NOTE: 使われてなさそうな値にしておく．
-    # display_image.py と合わせる必要あり．
-    status = 222
 
-if args["-o"] is not None:
-    out_file = args["-o"]
-else:
-    out_file = sys.stdout.buffer
 
-logging.info("Save {out_file}.".format(out_file=str(out_file)))
-convert_to_gray(img).save(out_file, "PNG")
+# NOTE: frame_data を渡した場合は，取得済みのデータで描画する．取得に失敗した
+# 場合は例外が渡されるので，エラー画面を描画する．
+def create_image(config, now=None, frame_data=None):
+    img = PIL.Image.new(
+        "RGBA",
+        (config["PANEL"]["DEVICE"]["WIDTH"], config["PANEL"]["DEVICE"]["HEIGHT"]),
+        (255, 255, 255, 255),
+    )
+
+    status = 0
+    try:
+        # NOTE: 描画に必要なデータは，描画を始める前にまとめて並列に取得しておく
+        if frame_data is None:
+            frame_data = fetch_frame_data([config], get_db_config(config), now)
+        elif isinstance(frame_data, Exception):
+            raise frame_data
+
+        draw_panel(config, img, frame_data, now)
+    except:
+        draw_error(config, img)
+        status = ERROR_STATUS
+
+    return (convert_to_gray(img), status)
+
+
+# NOTE: PANEL.OUTPUT が無い場合は，従来通り量子化せずに 8 bit の PNG を出力する
+def get_output_config(config):
+    output_config = config["PANEL"].get("OUTPUT", {})
+
+    return (output_config.get("FORMAT", "png"), output_config.get("DITHER"))
+
+
+def quantize_image(img, fmt, dither):
+    # NOTE: png4 と raw は 16 階調しか表せないので，必ず量子化する
+    if (fmt != "png") or (dither is not None):
+        img = quantize_gray(img, "none" if dither is None else dither)
+
+    return img
+
+
+# NOTE: 設定ファイルのレイアウトは PANEL.DEVICE の大きさ向けなので，異なる大きさ
+# (向きの異なる Kindle 等) で描画する場合は，大きさに関する設定を置き換える．
+# フォントや余白，アイコンは，縦横どちらにもはみ出さない倍率で拡大・縮小する．
+def get_layout_config(config, size):
+    device_config = config["PANEL"]["DEVICE"]
+    if (size is None) or (
+        tuple(size) == (device_config["WIDTH"], device_config["HEIGHT"])
+    ):
+        return config
+
+    width, height = size
+    scale = min(width / device_config["WIDTH"], height / device_config["HEIGHT"])
+    if scale < LAYOUT_SCALE_MIN:
+        raise ValueError(
+            "Image size {width}x{height} is too small for the layout of {device}".format(
+                width=width,
+                height=height,
+                device="{width}x{height}".format(
+                    width=device_config["WIDTH"], height=device_config["HEIGHT"]
+                ),
+            )
+        )
+
+    config = copy.deepcopy(config)
+    offset = int(round(config["GRAPH"]["OFFSET"] * scale))
+
+    config["PANEL"]["DEVICE"].update({"WIDTH": width, "HEIGHT": height, "SCALE": scale})
+    config["GRAPH"].update(
+        {"WIDTH": width, "HEIGHT": height - offset, "OFFSET": offset, "SCALE": scale}
+    )
+    config["USAGE"].update({"WIDTH": width, "HEIGHT": height, "SCALE": scale})
+    for icon_config in config["ICON"].values():
+        icon_config["SCALE"] = icon_config.get("SCALE", 1.0) * scale
+
+    return config
+
+
+def parse_size(size_str):
+    return tuple(int(value) for value in size_str.lower().split("x"))
+
+
+# NOTE: 設定を読み込んだ状態で常駐し，呼ばれる度に画像を生成する．
+# プロセス起動やモジュールの import，設定ファイルの読み込みを毎回行わずに
+# 済むように，display_image.py から直接使う．
+class Renderer:
+    def __init__(self, config_file, size=None):
+        logging.info(
+            "Using config config: {config_file}".format(config_file=config_file)
+        )
+        self.config = get_layout_config(load_config(config_file), size)
+
+    # NOTE: now は画像に表示する時刻．表示する時刻より前に描画する場合に指定する
+    def render(self, now=None, frame_data=None):
+        logging.info("Start to create image")
+        return create_image(self.config, now, frame_data)
+
+    # NOTE: 出力形式に合わせて量子化した画像を返す
+    def render_frame(self, fmt=None, dither=None, now=None, frame_data=None):
+        img, status = self.render(now, frame_data)
+
+        config_fmt, config_dither = get_output_config(self.config)
+        fmt = config_fmt if fmt is None else fmt
+        dither = config_dither if dither is None else dither
+
+        return (quantize_image(img, fmt, dither), status)
+
+    def render_data(self, fmt=None, dither=None, now=None):
+        img, status = self.render_frame(fmt, dither, now)
+
+        return (
+            encode_gray(img, get_output_config(self.config)[0] if fmt is None else fmt),
+            status,
+        )
+
+
+# NOTE: 大きさごとの Renderer で同じ時刻の画像を描画する．データは 1 回だけ
+# 取得し，全ての Renderer で同じものを使う．
+def render_frame_map(renderer_map, now=None):
+    config_list = [renderer.config for renderer in renderer_map.values()]
+    try:
+        frame_data = fetch_frame_data(config_list, get_db_config(config_list[0]), now)
+    except Exception as e:
+        frame_data = e
+
+    return {
+        size: renderer.render_frame(now=now, frame_data=frame_data)
+        for size, renderer in renderer_map.items()
+    }
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+
+    logger.init("panel.kindle.power", level=logging.INFO)
+
+    renderer = Renderer(
+        args["-c"], None if args["-s"] is None else parse_size(args["-s"])
+    )
+    now = None
+    if args["-t"] is not None:
+        now = datetime.datetime.fromisoformat(args["-t"])
+
+    data, status = renderer.render_data(args["-f"], args["-d"], now)
+
+    if args["-o"] is not None:
+        logging.info("Save {out_file}.".format(out_file=args["-o"]))
+        with open(args["-o"], "wb") as f:
+            f.write(data)
+    else:
+        logging.info("Save stdout.")
+        sys.stdout.buffer.write(data)
 
-exit(status)
+    exit(status)
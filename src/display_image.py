@@ -4,35 +4,64 @@
 電子ペーパ表示用の画像を表示します．
 
 Usage:
-  display_image.py [-c CONFIG] [-t HOSTNAME] [-s]
+  display_image.py [-c CONFIG] [-t HOSTNAME] [-s] [-i]
 
 Options:
   -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
-  -t HOSTNAME  : 表示を行う Raspberry Pi のホスト名．
+  -t HOSTNAME  : 表示を行う Kindle のホスト名．指定しない場合は，設定ファイルの
+                 PANEL.TARGET に列挙した全ての Kindle に表示します．
   -s           : 1回のみ表示
+  -i           : 画像の生成を別プロセス (create_image.py) で行います．
 """
 
 from docopt import docopt
 
-import paramiko
+import concurrent.futures
 import datetime
 import subprocess
 import time
 import sys
 import os
 import gc
+import hashlib
 import logging
 import pathlib
 import traceback
+import PIL.Image
 
 import logger
 from config import load_config
 import notify_slack
+import kindle_display
+from create_image import (
+    Renderer,
+    ERROR_STATUS,
+    get_output_config,
+    get_layout_config,
+    render_frame_map,
+)
+from pil_util import encode_gray, decode_gray, get_dirty_region, is_raw_supported
 
 NOTIFY_THRESHOLD = 2
 UPDATE_SEC = 60
 REFRESH = 60
 FAIL_MAX = 5
+TILE_SIZE = 64
+# NOTE: 変化した面積がこの割合を超える場合は，分割せずに全体を送る
+FULL_UPDATE_RATIO = 0.5
+
+# NOTE: 描画時間のばらつきを吸収するための余裕
+RENDER_MARGIN_SEC = 3
+LATENCY_ALPHA = 0.3
+
+latency_stat = {"render": None}
+
+# NOTE: 反時計回りに回転させる
+ROTATE_MAP = {
+    90: PIL.Image.ROTATE_90,
+    180: PIL.Image.ROTATE_180,
+    270: PIL.Image.ROTATE_270,
+}
 
 CREATE_IMAGE = os.path.dirname(os.path.abspath(__file__)) + "/create_image.py"
 
@@ -47,32 +76,359 @@ def notify_error(config, message):
     )
 
 
-def ssh_connect(hostname):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        hostname,
-        username="root",
-        password="mario",
-        allow_agent=False,
-        look_for_keys=False,
+# NOTE: tick は表示する予定の時刻．画像の時刻や本日の使用時間はこの時刻のものにする
+def create_image(config_file, tick, size):
+    command = [
+        "python3",
+        CREATE_IMAGE,
+        "-c",
+        config_file,
+        "-s",
+        "{width}x{height}".format(width=size[0], height=size[1]),
+    ]
+    if tick is not None:
+        command += ["-t", tick.isoformat()]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    data = proc.communicate()[0]
+
+    return (decode_gray(data, get_output_config(config)[0], size), proc.returncode)
+
+
+def get_update_config(config):
+    update_config = config["PANEL"]["UPDATE"]
+
+    return {
+        # NOTE: 残像が溜まらないように，この回数ごとに全体を -f 付きで書き換える
+        "refresh": update_config.get("REFRESH", REFRESH),
+        "partial": update_config.get("PARTIAL", False),
+        "tile": update_config.get("TILE", TILE_SIZE),
+    }
+
+
+# NOTE: 前回表示した画像と比較して，変化した領域だけを送って部分的に書き換える．
+# raw はフレームバッファに直接書き込むため，常に全体を送る．
+def get_region_list(display_state, img, fmt, update_config, is_refresh):
+    prev_img = display_state["img"]
+    full = (0, 0) + img.size
+
+    if (
+        is_refresh
+        or (fmt == "raw")
+        or (not update_config["partial"])
+        or (prev_img is None)
+        or (prev_img.size != img.size)
+    ):
+        return [full]
+
+    region_list = get_dirty_region(prev_img, img, update_config["tile"])
+
+    area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in region_list)
+    if area > img.size[0] * img.size[1] * FULL_UPDATE_RATIO:
+        return [full]
+
+    return region_list
+
+
+def update_latency(stat, name, sec, label=""):
+    if stat[name] is None:
+        stat[name] = sec
+    else:
+        stat[name] += (sec - stat[name]) * LATENCY_ALPHA
+
+    logging.info(
+        "{label}{name}: {sec:.2f} sec (average: {average:.2f} sec)".format(
+            label=label, name=name.capitalize(), sec=sec, average=stat[name]
+        )
     )
 
-    return ssh
 
+# NOTE: renderer_map は描画する画像の大きさごとの Renderer (別プロセスで描画する
+# 場合は None)．大きさごとの画像と，描画に失敗したものがあればその終了コードを返す．
+def render_image(renderer_map, config_file, is_isolate, tick=None):
+    start = time.perf_counter()
+
+    if is_isolate:
+        # NOTE: 別プロセスで描画する場合は，データの取得も大きさごとに行われる
+        result_map = {
+            size: create_image(config_file, tick, size) for size in renderer_map
+        }
+    else:
+        result_map = render_frame_map(renderer_map, tick)
+
+    img_map = {}
+    status = 0
+    for size, (img, size_status) in result_map.items():
+        img_map[size] = img
+        if status == 0:
+            status = size_status
+
+    update_latency(latency_stat, "render", time.perf_counter() - start)
+
+    return (img_map, status)
+
+
+def get_target_list(config, hostname):
+    device_config = config["PANEL"]["DEVICE"]
+
+    if hostname is not None:
+        target_config_list = [{"HOST": hostname}]
+    elif "TARGET" in config["PANEL"]:
+        target_config_list = config["PANEL"]["TARGET"]
+    else:
+        raise ValueError(
+            "No Kindle to display: set PANEL.TARGET in the config, "
+            + "or specify -t HOSTNAME (or KINDLE_HOSTNAME)"
+        )
+
+    target_list = []
+    for target_config in target_config_list:
+        rotate = target_config.get("ROTATE", 0)
+        if (rotate != 0) and (rotate not in ROTATE_MAP):
+            raise ValueError(
+                "Unsupported ROTATE of {host}: {rotate} (0, 90, 180 or 270)".format(
+                    host=target_config["HOST"], rotate=rotate
+                )
+            )
 
-def display_image(ssh):
-    ssh_stdin = ssh.exec_command(
-        "cat - > draw.png && eips %s -g draw.png"
-        % ("-f" if (i % REFRESH) == 0 else ""),
-    )[0]
-
-    proc = subprocess.Popen(["python3", CREATE_IMAGE], stdout=subprocess.PIPE)
-    ssh_stdin.write(proc.communicate()[0])
-    ssh_stdin.close()
+        geometry = (
+            target_config.get("WIDTH", device_config["WIDTH"]),
+            target_config.get("HEIGHT", device_config["HEIGHT"]),
+            rotate,
+        )
+        # NOTE: レイアウトが収まらない大きさの場合は，ここでエラーにする
+        get_layout_config(config, get_render_size(geometry))
+
+        target_list.append(
+            {
+                "name": target_config["HOST"],
+                "geometry": geometry,
+                "session": kindle_display.create_session(target_config["HOST"]),
+                "display": {"img": None, "hash": None, "sent": 0, "skipped": 0},
+                "latency": {"transfer": None},
+                "fail_count": 0,
+                "push": None,
+            }
+        )
+
+    return target_list
+
+
+# NOTE: WIDTH と HEIGHT は Kindle の画面の大きさなので，90 度か 270 度回転させる
+# 場合は縦横を入れ替えた大きさで描画する
+def get_render_size(geometry):
+    width, height, rotate = geometry
+
+    if rotate in [90, 270]:
+        return (height, width)
+    else:
+        return (width, height)
+
+
+# NOTE: 描画は画像の大きさごとに 1 回だけ行い，同じ大きさの Kindle には同じ
+# 画像を使う．回転は描画後に行う．
+def get_frame_map(img_map, target_list):
+    frame_map = {}
+    for geometry in dict.fromkeys(target["geometry"] for target in target_list):
+        frame = img_map[get_render_size(geometry)]
+        if geometry[2] != 0:
+            frame = frame.transpose(ROTATE_MAP[geometry[2]])
+
+        frame_map[geometry] = frame
+
+    return frame_map
+
+
+# NOTE: raw はフレームバッファに直接書き込むので，Kindle から読み取った形式に
+# 対応できない場合は 16 階調の PNG で送る
+def get_target_format(target, img):
+    fmt = get_output_config(config)[0]
+    fb = target["session"]["fb"]
+
+    if (fmt == "raw") and not is_raw_supported(fb, img.size):
+        # NOTE: 毎回出力しないように，全体を送る場合のみ出力する
+        if target["display"]["img"] is None:
+            logging.warning(
+                "[{name}] Unsupported framebuffer {fb}, use png4 instead".format(
+                    name=target["name"], fb=fb
+                )
+            )
+        return "png4"
+
+    return fmt
+
+
+def display_image(target, img):
+    session = target["session"]
+    display_state = target["display"]
+    label = "[{name}] ".format(name=target["name"])
+
+    fmt = get_target_format(target, img)
+    update_config = get_update_config(config)
+    is_refresh = (i % update_config["refresh"]) == 0
+
+    # NOTE: 前回表示したものと全く同じ画像の場合は，転送も表示も行わない．
+    # ただし，定期的な全体の書き換えは残像を消すためのものなので省略しない．
+    digest = hashlib.sha1(img.tobytes()).hexdigest()
+    if (not is_refresh) and (digest == display_state["hash"]):
+        display_state["skipped"] += 1
+        logging.info(
+            "{label}Skip unchanged frame (sent: {sent}, skipped: {skipped})".format(
+                label=label,
+                sent=display_state["sent"],
+                skipped=display_state["skipped"],
+            )
+        )
+        return
+
+    region_list = get_region_list(display_state, img, fmt, update_config, is_refresh)
+
+    # NOTE: 途中で失敗すると表示内容が分からなくなるので，次回は全体を送らせる
+    display_state["img"] = None
+    display_state["hash"] = None
+
+    start = time.perf_counter()
+    size = 0
+    for region in region_list:
+        is_full = region == (0, 0) + img.size
+        size += kindle_display.send_frame(
+            session,
+            encode_gray(img if is_full else img.crop(region), fmt, session["fb"]),
+            region[0:2],
+            is_refresh,
+            fmt,
+        )
+
+    update_latency(target["latency"], "transfer", time.perf_counter() - start, label)
+
+    display_state["img"] = img
+    display_state["hash"] = digest
+    display_state["sent"] += 1
+
+    logging.info(
+        (
+            "{label}Send {count} region(s), {size:,} bytes{refresh} "
+            + "(sent: {sent}, skipped: {skipped})"
+        ).format(
+            label=label,
+            count=len(region_list),
+            size=size,
+            refresh=" (refresh)" if is_refresh else "",
+            sent=display_state["sent"],
+            skipped=display_state["skipped"],
+        )
+    )
     sys.stdout.flush()
 
-    return proc
+
+# NOTE: Kindle ごとに失敗を数え，1 台が応答しなくても他の Kindle への表示は続ける
+def update_target(target, img):
+    session = target["session"]
+
+    try:
+        if not kindle_display.ensure_connected(session):
+            raise RuntimeError("Not connected to {name}".format(name=target["name"]))
+
+        try:
+            display_image(target, img)
+        except:
+            kindle_display.close(session)
+            raise
+
+        target["fail_count"] = 0
+        return True
+    except:
+        target["fail_count"] += 1
+        logging.warning(
+            "[{name}] Failed to display ({count} times)".format(
+                name=target["name"], count=target["fail_count"]
+            )
+        )
+        logging.debug(traceback.format_exc())
+
+        if target["fail_count"] == NOTIFY_THRESHOLD:
+            notify_error(
+                config,
+                "[{name}]\n{trace}".format(
+                    name=target["name"], trace=traceback.format_exc()
+                ),
+            )
+        return False
+
+
+# NOTE: 各 Kindle への転送は並列に行い，deadline までに終わったものの結果を返す．
+# 応答しない Kindle があっても他の Kindle の表示を遅らせないように，終わるのを
+# 待たずに次の描画に進み，前回の転送が終わっていない Kindle はその回を飛ばす．
+def push_frame(frame_map, target_list, deadline=None):
+    for target in target_list:
+        if (target["push"] is not None) and (not target["push"].done()):
+            logging.warning(
+                "[{name}] Skip this frame (previous transfer is still running)".format(
+                    name=target["name"]
+                )
+            )
+            continue
+
+        target["push"] = display_executor.submit(
+            update_target, target, frame_map[target["geometry"]]
+        )
+
+    if deadline is None:
+        timeout = None
+    else:
+        timeout = max((deadline - datetime.datetime.now()).total_seconds(), 0)
+    done = concurrent.futures.wait([target["push"] for target in target_list], timeout)[
+        0
+    ]
+
+    return [
+        (target["push"] in done) and target["push"].result() for target in target_list
+    ]
+
+
+# NOTE: 更新されていることが直感的に理解しやすくなるように，更新タイミングを 0 秒
+# に合わせる
+# (例えば，1分間隔更新だとして，1分40秒に更新されると，2分40秒まで更新されないので
+# 2分45秒くらいに表示を見た人は本当に1分間隔で更新されているのか心配になる)
+def get_next_tick(tick, interval):
+    now = datetime.datetime.now()
+
+    if tick is None:
+        return now.replace(microsecond=0) + datetime.timedelta(
+            seconds=interval - now.second
+        )
+
+    # NOTE: 転送は 0 秒より前に終わることがあるので，前回の予定時刻から求める
+    tick += datetime.timedelta(seconds=interval)
+    while tick <= now:
+        tick += datetime.timedelta(seconds=interval)
+
+    return tick
+
+
+def sleep_until(target, label):
+    sleep_time = (target - datetime.datetime.now()).total_seconds()
+    if sleep_time <= 0:
+        return
+
+    logging.info(
+        "sleep {sleep_time:.1f} sec until {label}...".format(
+            sleep_time=sleep_time, label=label
+        )
+    )
+    sys.stderr.flush()
+    time.sleep(sleep_time)
+
+
+# NOTE: 0 秒に表示し終わるように，転送に掛かる時間だけ前に転送を始め，
+# さらに描画に掛かる時間 (と余裕) だけ前に描画を始める
+def get_start_time(tick, target_list):
+    transfer_latency = max(target["latency"]["transfer"] or 0 for target in target_list)
+    transfer_start = tick - datetime.timedelta(seconds=transfer_latency)
+    render_start = transfer_start - datetime.timedelta(
+        seconds=(latency_stat["render"] or 0) + RENDER_MARGIN_SEC
+    )
+
+    return (render_start, transfer_start)
 
 
 ######################################################################
@@ -81,45 +437,79 @@ args = docopt(__doc__)
 logger.init("panel.kindle.power", level=logging.INFO)
 
 is_one_time = args["-s"]
+is_isolate = args["-i"]
 kindle_hostname = os.environ.get("KINDLE_HOSTNAME", args["-t"])
 
-logging.info("Kindle hostname: %s" % (kindle_hostname))
-
 config = load_config(args["-c"])
 
 try:
-    ssh = ssh_connect(kindle_hostname)
-    logging.info("put the kindle into signage mode")
-    ssh.exec_command("initctl stop powerd")
-    ssh.exec_command("initctl stop framework")
-except:
-    notify_error(config, traceback.format_exc())
-    logging.error(traceback.format_exc())
+    target_list = get_target_list(config, kindle_hostname)
+except ValueError as e:
+    logging.error(e)
     sys.exit(-1)
+logging.info(
+    "Kindle hostname: {name_list}".format(
+        name_list=", ".join(target["name"] for target in target_list)
+    )
+)
+
+# NOTE: 毎回プロセスを起動すると，モジュールの import やフォントの読み込みに
+# 描画以上の時間がかかるので，同じプロセス内で画像を生成する．
+# 画像の大きさごとにレイアウトが異なるので，Renderer は大きさごとに用意する．
+renderer_map = {
+    size: (None if is_isolate else Renderer(args["-c"], size))
+    for size in dict.fromkeys(
+        get_render_size(target["geometry"]) for target in target_list
+    )
+}
 
+# NOTE: 描画は別スレッドで先行して行い，表示のタイミングでは描画済みの画像を
+# 転送するだけで済むようにする．(描画は常にこのスレッドで行われる)
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# NOTE: 各 Kindle への転送は並列に行う
+display_executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(target_list))
 
 i = 0
 fail_count = 0
+tick = None
+future = executor.submit(render_image, renderer_map, args["-c"], is_isolate)
 while True:
-    ssh_stdin = None
     try:
-        proc = display_image(ssh)
+        img_map, status = future.result()
+        frame_map = get_frame_map(img_map, target_list)
 
-        if proc.returncode == 0:
+        if tick is not None:
+            sleep_until(get_start_time(tick, target_list)[1], "transfer")
+        if is_one_time:
+            deadline = None
+        else:
+            # NOTE: 次の描画を始めるまでに終わらなかった転送は，待たずに失敗とみなす
+            deadline = get_start_time(
+                get_next_tick(tick, config["PANEL"]["UPDATE"]["INTERVAL"]),
+                target_list,
+            )[0]
+        result_list = push_frame(frame_map, target_list, deadline)
+
+        if status == 0:
             logging.info("Success.")
-        elif proc.returncode == 222:
+        elif status == ERROR_STATUS:
             logging.warn("Finish. (something is wrong)")
             raise
         else:
-            logging.error(
-                "Failed to create image. (code: {code})".format(code=proc.returncode)
-            )
+            logging.error("Failed to create image. (code: {code})".format(code=status))
             raise
 
-        logging.info("Success.")
-        pathlib.Path(config["LIVENESS"]["FILE"]).touch()
+        # NOTE: 描画に関する失敗のみをここで数える．表示の失敗は Kindle ごとに数える．
+        fail_count = 0
+
+        # NOTE: どれか 1 台にでも表示できていれば，動作しているとみなす
+        if any(result_list):
+            pathlib.Path(config["LIVENESS"]["FILE"]).touch()
 
         if is_one_time:
+            if not all(result_list):
+                logging.error("Failed to display on some Kindles.")
+                sys.exit(-1)
             break
     except:
         fail_count += 1
@@ -128,22 +518,11 @@ while True:
             notify_error(config, traceback.format_exc())
             logging.error("エラーが続いたので終了します．")
             raise
-        else:
-            time.sleep(10)
-            ssh = ssh_connect(kindle_hostname)
-            pass
 
-    # close だけだと，SSH 側がしばらく待っていることがあったので，念のため
-    del ssh_stdin
     gc.collect()
 
-    # 更新されていることが直感的に理解しやすくなるように，更新タイミングを 0 秒
-    # に合わせる
-    # (例えば，1分間隔更新だとして，1分40秒に更新されると，2分40秒まで更新されないので
-    # 2分45秒くらいに表示を見た人は本当に1分間隔で更新されているのか心配になる)
-    sleep_time = config["PANEL"]["UPDATE"]["INTERVAL"] - datetime.datetime.now().second
-    logging.info("sleep {sleep_time} sec...".format(sleep_time=sleep_time))
-    sys.stderr.flush()
-    time.sleep(sleep_time)
+    tick = get_next_tick(tick, config["PANEL"]["UPDATE"]["INTERVAL"])
+    sleep_until(get_start_time(tick, target_list)[0], "render")
+    future = executor.submit(render_image, renderer_map, args["-c"], is_isolate, tick)
 
     i += 1
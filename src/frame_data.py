@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import logging
+import time
+import types
+
+import sensor_graph
+import usage_panel
+
+
+def run_job(label, job):
+    start = time.perf_counter()
+    result = job()
+
+    logging.info(
+        "Fetch {label}: {elapsed:.3f} sec".format(
+            label=label, elapsed=time.perf_counter() - start
+        )
+    )
+
+    return result
+
+
+# NOTE: 各クエリを並列に実行し，結果を読み取り専用の辞書にまとめる．
+# 描画処理はこの辞書から結果を取り出す．
+def fetch_job_map(job_map, concurrency):
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        future_map = {
+            key: executor.submit(run_job, label, job)
+            for key, (label, job) in job_map.items()
+        }
+        result = {key: future.result() for key, future in future_map.items()}
+
+    logging.info(
+        "Fetch {count} queries with concurrency {concurrency}: {elapsed:.3f} sec".format(
+            count=len(job_map),
+            concurrency=concurrency,
+            elapsed=time.perf_counter() - start,
+        )
+    )
+
+    return types.MappingProxyType(result)
+
+
+# NOTE: 大きさの異なる画像を描画する場合も，データの取得は 1 回にまとめる．
+# 条件が同じクエリはキーが一致するので，1 回だけ実行される．
+def fetch_frame_data(config_list, db_config, now=None):
+    job_map = {}
+    for config in config_list:
+        job_map.update(sensor_graph.get_fetch_job_map(config["GRAPH"], db_config))
+        job_map.update(usage_panel.get_fetch_job_map(config["USAGE"], db_config, now))
+
+    return fetch_job_map(job_map, db_config["concurrency"])
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kindle に常駐させた表示用のシェルに，画像を送って表示させます．
+
+Usage:
+  kindle_display.py -t HOSTNAME [-f PNG_FILE]
+
+Options:
+  -t HOSTNAME  : 表示を行う Kindle のホスト名．
+  -f PNG_FILE  : 表示する画像．[default: test.png]
+"""
+
+from docopt import docopt
+
+import paramiko
+import time
+import logging
+import traceback
+
+KEEPALIVE_SEC = 30
+# NOTE: 応答しない Kindle に接続しようとして，OS の TCP のタイムアウト (2 分程度)
+# まで待たないようにする
+CONNECT_TIMEOUT_SEC = 10
+ACK_TIMEOUT_SEC = 30
+RECONNECT_WAIT_SEC = 2
+RECONNECT_WAIT_MAX_SEC = 60
+
+# NOTE: Kindle 側で常駐させるシェル．ヘッダ行「長さ X Y 全体書き換え 形式」を
+# 読んだ後，続く本体を head -c で RAM 上の /tmp に書き出して eips で表示し，
+# 終わったら "OK 終了コード" を返す．フレームごとにチャンネルを開き直したり，
+# 作業ディレクトリ (フラッシュ) に書き込んだりしないようにする．
+HELPER_SCRIPT = """
+while read len x y refresh fmt; do
+  if [ "$refresh" = 1 ]; then opt=-f; else opt=; fi
+  if [ "$fmt" = raw ]; then
+    head -c $len > /dev/fb0 && eips $opt '' > /dev/null 2>&1
+  else
+    head -c $len > /tmp/kindle_panel.png && eips $opt -g /tmp/kindle_panel.png -x $x -y $y > /dev/null 2>&1
+  fi
+  echo "OK $?"
+done
+"""
+
+
+def ssh_connect(hostname):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(
+        hostname,
+        username="root",
+        password="mario",
+        allow_agent=False,
+        look_for_keys=False,
+        timeout=CONNECT_TIMEOUT_SEC,
+        banner_timeout=CONNECT_TIMEOUT_SEC,
+        auth_timeout=CONNECT_TIMEOUT_SEC,
+    )
+
+    # NOTE: 表示の間隔が空いても，途中の NAT 等で切断されないようにする
+    ssh.get_transport().set_keepalive(KEEPALIVE_SEC)
+
+    return ssh
+
+
+# NOTE: 接続する度に，Kindle を表示専用の状態にする
+SETUP_COMMAND_LIST = ["initctl stop powerd", "initctl stop framework"]
+
+# NOTE: raw で書き込む際に形式を合わせるため，フレームバッファの 1 画素のビット数と
+# 1 行のバイト数を読み取る
+FB_GEOMETRY_COMMAND = (
+    "cat /sys/class/graphics/fb0/bits_per_pixel /sys/class/graphics/fb0/stride"
+)
+
+
+def get_fb_geometry(ssh):
+    try:
+        stdout = ssh.exec_command(FB_GEOMETRY_COMMAND, timeout=CONNECT_TIMEOUT_SEC)[1]
+        bpp, stride = map(int, stdout.read().decode().split())
+    except:
+        logging.warning("Failed to read framebuffer geometry")
+        logging.debug(traceback.format_exc())
+        return None
+
+    return {"bpp": bpp, "stride": stride}
+
+
+def start_helper(session):
+    for command in SETUP_COMMAND_LIST:
+        session["ssh"].exec_command(command)
+
+    session["fb"] = get_fb_geometry(session["ssh"])
+    logging.info(
+        "Framebuffer of {hostname}: {fb}".format(
+            hostname=session["hostname"], fb=session["fb"]
+        )
+    )
+
+    stdin, stdout = session["ssh"].exec_command(HELPER_SCRIPT)[0:2]
+    stdout.channel.settimeout(ACK_TIMEOUT_SEC)
+
+    session["stdin"] = stdin
+    session["stdout"] = stdout
+
+
+def create_session(hostname):
+    return {
+        "hostname": hostname,
+        "ssh": None,
+        "stdin": None,
+        "stdout": None,
+        "fb": None,
+        "wait_sec": RECONNECT_WAIT_SEC,
+        "retry_at": 0.0,
+    }
+
+
+def connect(hostname):
+    session = create_session(hostname)
+    session["ssh"] = ssh_connect(hostname)
+    start_helper(session)
+
+    logging.info("Start display helper on {hostname}".format(hostname=hostname))
+
+    return session
+
+
+def close(session):
+    if session.get("ssh") is None:
+        return
+
+    try:
+        if session["stdin"] is not None:
+            session["stdin"].close()
+        session["ssh"].close()
+    except:
+        logging.warning(traceback.format_exc())
+
+    session["ssh"] = None
+
+
+# NOTE: 切断されている場合は接続し直す．失敗した場合は待ち時間を倍にしながら
+# 次の試行時刻を決め，それまでは接続を試みずに False を返す．
+# (他の Kindle への表示を止めないように，ここでは待たない)
+def ensure_connected(session):
+    if session["ssh"] is not None:
+        return True
+    if time.monotonic() < session["retry_at"]:
+        return False
+
+    try:
+        session["ssh"] = ssh_connect(session["hostname"])
+        start_helper(session)
+    except:
+        close(session)
+        session["retry_at"] = time.monotonic() + session["wait_sec"]
+
+        logging.warning(
+            "Failed to connect to {hostname} (retry in {wait} sec)".format(
+                hostname=session["hostname"], wait=session["wait_sec"]
+            )
+        )
+        logging.debug(traceback.format_exc())
+
+        session["wait_sec"] = min(session["wait_sec"] * 2, RECONNECT_WAIT_MAX_SEC)
+        return False
+
+    session["wait_sec"] = RECONNECT_WAIT_SEC
+    logging.info(
+        "Start display helper on {hostname}".format(hostname=session["hostname"])
+    )
+
+    return True
+
+
+def send_frame(session, data, pos=(0, 0), is_refresh=False, fmt="png"):
+    session["stdin"].write(
+        "{size} {x} {y} {refresh} {fmt}\n".format(
+            size=len(data),
+            x=pos[0],
+            y=pos[1],
+            refresh=1 if is_refresh else 0,
+            fmt="raw" if fmt == "raw" else "png",
+        ).encode()
+    )
+    session["stdin"].write(data)
+    session["stdin"].flush()
+
+    ack = session["stdout"].readline().strip()
+    if not ack.startswith("OK"):
+        raise RuntimeError("Unexpected response from Kindle: {ack}".format(ack=ack))
+    if ack != "OK 0":
+        logging.warning("Display command failed ({ack})".format(ack=ack))
+
+    return len(data)
+
+
+if __name__ == "__main__":
+    import logger
+
+    args = docopt(__doc__)
+
+    logger.init("test", logging.INFO)
+
+    session = connect(args["-t"])
+    with open(args["-f"], "rb") as f:
+        send_frame(session, f.read(), is_refresh=True)
+    close(session)
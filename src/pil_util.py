@@ -1,27 +1,58 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import io
 import os
 import pathlib
+import functools
+import numpy as np
+import PIL.Image
 import PIL.ImageDraw
+import PIL.ImageEnhance
+import PIL.ImageFont
 import logging
 
 # NOTE: 詳細追えてないものの，英語フォントでボディサイズがおかしいものがあったので，
 # 補正できるようにする．
 EN_FONT_HEIGHT_FACTOR = 0.75
 
+# NOTE: 読み込んだフォントはプロセス内で使い回す．(パス, サイズ) ごとに保持する．
+# (大きさの異なる Kindle に表示する場合は，大きさごとに別のフォントになる)
+FONT_CACHE_SIZE = 64
 
-def get_font(config, font_type, size):
-    font_path = str(
+
+def get_font_path(config, font_type):
+    return str(
         pathlib.Path(
             os.path.dirname(__file__), config["PATH"], config["MAP"][font_type]
+        ).resolve()
+    )
+
+
+def log_cache_info(name, func):
+    info = func.cache_info()
+    total = info.hits + info.misses
+
+    logging.debug(
+        "{name} cache (load: {load}, hit: {hit}, hit rate: {rate:.1f}%)".format(
+            name=name,
+            load=info.misses,
+            hit=info.hits,
+            rate=0.0 if total == 0 else info.hits * 100.0 / total,
         )
     )
 
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path, size):
     logging.info("Load font: {path}".format(path=font_path))
 
     return PIL.ImageFont.truetype(font_path, size)
 
 
+def get_font(config, font_type, size):
+    return load_font(get_font_path(config, font_type), size)
+
+
 def text_size(font, text, need_padding_change=True):
     size = font.getsize(text)
 
@@ -85,6 +116,30 @@ def load_image(img_config):
     return img
 
 
+# NOTE: アイコンは描画の度に読み込みや縮小を行わないように，変換済みの画像を
+# 保持しておく．元の画像ファイルが更新された場合のみ読み込み直す．
+icon_store = {}
+
+
+def load_icon(img_config, mode="RGBA"):
+    path = pathlib.Path(os.path.dirname(__file__), img_config["PATH"])
+    mtime = path.stat().st_mtime
+    key = (
+        str(path.resolve()),
+        img_config.get("SCALE"),
+        img_config.get("BRIGHTNESS"),
+        mode,
+    )
+
+    icon = icon_store.get(key)
+    if (icon is None) or (icon["mtime"] != mtime):
+        logging.info("Load icon: {path}".format(path=str(path)))
+        icon = {"mtime": mtime, "img": load_image(img_config).convert(mode)}
+        icon_store[key] = icon
+
+    return icon["img"]
+
+
 def alpha_paste(img, paint_img, pos):
     canvas = PIL.Image.new(
         "RGBA",
@@ -95,9 +150,186 @@ def alpha_paste(img, paint_img, pos):
     img.alpha_composite(canvas, (0, 0))
 
 
+# NOTE: ガンマ補正用のテーブルは描画の度に作る必要が無いので，最初に作っておく
+GAMMA = 2.2
+GAMMA_LUT = [int(pow(x / 255.0, GAMMA) * 255) for x in range(256)]
+INV_GAMMA_LUT = [int(pow(x / 255.0, 1.0 / GAMMA) * 255) for x in range(256)]
+# NOTE: RGBA の場合，A はそのまま (L への変換時に無視される)
+GAMMA_LUT_MAP = {
+    "RGB": GAMMA_LUT * 3,
+    "RGBA": GAMMA_LUT * 3 + list(range(256)),
+}
+
+
+# NOTE: RGBA のまま 1 回の point でガンマ補正してから L に変換することで，
+# RGB への変換 (中間画像の生成) を省く．結果は RGB を経由した場合と一致する．
 def convert_to_gray(img):
-    img = img.convert("RGB")
-    img = img.point(([int(pow(x / 255.0, 2.2) * 255) for x in range(256)] * 3))
-    img = img.convert("L")
-    img = img.point([int(pow(x / 255.0, 1.0 / 2.2) * 255) for x in range(256)])
-    return img
+    if img.mode not in GAMMA_LUT_MAP:
+        img = img.convert("RGB")
+
+    return img.point(GAMMA_LUT_MAP[img.mode]).convert("L").point(INV_GAMMA_LUT)
+
+
+# NOTE: Kindle の電子ペーパは 16 階調しか表示できないので，送る前に量子化しておく
+EINK_GRAY_LEVEL = 16
+EINK_GRAY_STEP = 255 // (EINK_GRAY_LEVEL - 1)
+EINK_GRAY_LUT = [int(round(x / EINK_GRAY_STEP)) * EINK_GRAY_STEP for x in range(256)]
+EINK_INDEX_LUT = [int(round(x / EINK_GRAY_STEP)) for x in range(256)]
+EINK_PALETTE = [
+    value for i in range(EINK_GRAY_LEVEL) for value in [i * EINK_GRAY_STEP] * 3
+]
+EINK_PALETTE_IMG = PIL.Image.new("P", (1, 1))
+EINK_PALETTE_IMG.putpalette(EINK_PALETTE)
+
+# NOTE: ordered dither 用の閾値 (4x4 の Bayer 行列)
+BAYER_MATRIX = (
+    np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) + 0.5
+) / 16.0
+
+# NOTE: raw で書き出すフレームバッファの形式．bpp が 4 の場合は 1 バイトに 2 画素
+# (上位 4 bit が左側) を詰め，0 が白になるように反転する．8 の場合は 1 バイトに
+# 1 画素で 0 が黒．各行は stride バイトまで 0 で埋める．
+EINK_RAW_BPP_LIST = [4, 8]
+
+
+def get_raw_geometry(size, fb=None):
+    if fb is not None:
+        return fb
+
+    # NOTE: デバイスの情報が無い場合 (ファイルへの出力) は，詰めた 4bpp とする
+    return {"bpp": 4, "stride": (size[0] + 1) // 2}
+
+
+def is_raw_supported(fb, size):
+    return (
+        (fb is not None)
+        and (fb["bpp"] in EINK_RAW_BPP_LIST)
+        and (fb["stride"] * 8 // fb["bpp"] >= size[0])
+    )
+
+
+def quantize_gray(img, dither="none"):
+    if dither == "none":
+        return img.point(EINK_GRAY_LUT)
+    elif dither == "ordered":
+        value = np.asarray(img, dtype=np.float32) / EINK_GRAY_STEP
+        height, width = value.shape
+        threshold = np.tile(BAYER_MATRIX, (height // 4 + 1, width // 4 + 1))
+        level = np.minimum(
+            np.floor(value + threshold[:height, :width]), EINK_GRAY_LEVEL - 1
+        )
+        return PIL.Image.fromarray((level * EINK_GRAY_STEP).astype(np.uint8), "L")
+    elif dither == "floyd_steinberg":
+        # NOTE: L のままパレットを指定して量子化すると誤差拡散されないので，
+        # RGB を経由する
+        return (
+            img.convert("RGB")
+            .quantize(palette=EINK_PALETTE_IMG, dither=PIL.Image.FLOYDSTEINBERG)
+            .convert("L")
+        )
+    else:
+        raise ValueError("Unknown dither: {dither}".format(dither=dither))
+
+
+def encode_raw(img, fb):
+    fb = get_raw_geometry(img.size, fb)
+    if not is_raw_supported(fb, img.size):
+        raise ValueError(
+            "Unsupported framebuffer (bpp: {bpp}, stride: {stride}, width: {width})".format(
+                width=img.size[0], **fb
+            )
+        )
+
+    index = np.asarray(img.point(EINK_INDEX_LUT), dtype=np.uint8)
+    if fb["bpp"] == 4:
+        index = (EINK_GRAY_LEVEL - 1) - index
+        if index.shape[1] % 2 != 0:
+            index = np.pad(index, ((0, 0), (0, 1)))
+        line = (index[:, 0::2] << 4) | index[:, 1::2]
+    else:
+        line = index * EINK_GRAY_STEP
+
+    return np.pad(line, ((0, 0), (0, fb["stride"] - line.shape[1]))).tobytes()
+
+
+def decode_raw(data, size, fb):
+    fb = get_raw_geometry(size, fb)
+
+    line = np.frombuffer(data, dtype=np.uint8).reshape(size[1], fb["stride"])
+    if fb["bpp"] == 4:
+        index = np.empty((size[1], fb["stride"] * 2), dtype=np.uint8)
+        index[:, 0::2] = line >> 4
+        index[:, 1::2] = line & 0x0F
+        index = (EINK_GRAY_LEVEL - 1) - index
+        value = index * EINK_GRAY_STEP
+    else:
+        value = line
+
+    return PIL.Image.fromarray(np.ascontiguousarray(value[:, : size[0]]), "L")
+
+
+# NOTE: fb は raw の場合のフレームバッファの形式 (bpp と 1 行のバイト数)
+def encode_gray(img, fmt="png", fb=None):
+    if fmt == "raw":
+        return encode_raw(img, fb)
+
+    buf = io.BytesIO()
+    if fmt == "png":
+        img.save(buf, "PNG")
+    elif fmt == "png4":
+        # NOTE: 16 階調のグレーのパレットを持つ 4 bit の PNG として書き出す
+        index_img = img.point(EINK_INDEX_LUT)
+        index_img.putpalette(EINK_PALETTE)
+        index_img.save(buf, "PNG", bits=4)
+    else:
+        raise ValueError("Unknown format: {fmt}".format(fmt=fmt))
+
+    return buf.getvalue()
+
+
+def decode_gray(data, fmt, size, fb=None):
+    if fmt == "raw":
+        return decode_raw(data, size, fb)
+    else:
+        return PIL.Image.open(io.BytesIO(data)).convert("L")
+
+
+# NOTE: 前回の画像から変化した領域を，tile 単位に切り上げた矩形のリストで返す．
+# 横に連続する tile をまとめた後，同じ幅で縦に連続するものをまとめる．
+def get_dirty_region(prev_img, img, tile):
+    prev = np.asarray(prev_img)
+    curr = np.asarray(img)
+    height, width = curr.shape
+
+    pad = ((0, -height % tile), (0, -width % tile))
+    changed = np.pad(prev != curr, pad)
+    tile_map = changed.reshape(
+        changed.shape[0] // tile, tile, changed.shape[1] // tile, tile
+    ).any(axis=(1, 3))
+
+    region_list = []
+    open_map = {}
+    for row in range(tile_map.shape[0]):
+        edge = np.diff(np.concatenate([[0], tile_map[row].astype(np.int8), [0]]))
+        run_list = zip(np.flatnonzero(edge == 1), np.flatnonzero(edge == -1))
+
+        next_open_map = {}
+        for run in run_list:
+            run = (int(run[0]), int(run[1]))
+            region = open_map.pop(run, None)
+            if region is None:
+                region = [run[0], row, run[1], row + 1]
+                region_list.append(region)
+            region[3] = row + 1
+            next_open_map[run] = region
+        open_map = next_open_map
+
+    return [
+        (
+            x0 * tile,
+            y0 * tile,
+            min(x1 * tile, width),
+            min(y1 * tile, height),
+        )
+        for x0, y0, x1, y1 in region_list
+    ]
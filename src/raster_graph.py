@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+センサーデータのグラフを，matplotlib を使わずに NumPy と PIL で直接描画します．
+
+Usage:
+  raster_graph.py [-c CONFIG] [-o PNG_FILE]
+
+Options:
+  -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
+  -o PNG_FILE  : 生成した画像を指定されたパスに保存します．[default: test.png]
+"""
+
+from docopt import docopt
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+import logging
+import matplotlib.ticker
+
+from sensor_graph import (
+    IMAGE_DPI,
+    GRAPH_HSPACE,
+    VSPAN_ALPHA,
+    FACE_DEF_MAP,
+    get_plot_data,
+    get_graph_row_param,
+)
+from pil_util import get_font, load_font, log_cache_info
+from config import get_layout_scale
+
+# NOTE: 電子ペーパに表示するだけなので，グレースケールで直接描画する．
+# 色は sensor_graph.py の plot_item で指定しているものに合わせる．
+COLOR_MAP = {
+    "background": 0xFF,
+    "axis": 0x00,
+    "line": 0x99,
+    "fill": 0xAA,
+    "marker_face": 0xCC,
+    "marker_edge": 0x33,
+    "title": 0x11,
+    "value": 0x0D,  # NOTE: 黒の alpha=0.95
+}
+FILL_ALPHA = 0.5
+GRID_ALPHA = 0.1
+
+
+# NOTE: 線の太さや余白の大きさ (pt)．sensor_graph.py で matplotlib が使う値に合わせる
+SIZE_DEF_MAP = {
+    "line_width": 5.0,
+    "marker_size": 8.0,
+    "marker_edge_width": 5.0,
+    "tick_major_size": 3.5,
+    "tick_minor_size": 2.0,
+    "tick_pad": 3.5,
+    "title_pad": 6.0,
+    # NOTE: tight_layout のデフォルトの余白 (フォントサイズ 10pt の 1.08 倍)
+    "layout_pad": 10.8,
+}
+LINE_SPACING = 1.2
+CORNER_ANGLE = np.pi / 6
+
+
+# NOTE: matplotlib と同じ大きさになるように，pt 単位の値を px に換算する．
+# 異なる大きさで描画する場合は，sensor_graph.py で DPI を変えるのに合わせる．
+def pt2px(pt, scale=1.0):
+    return pt * IMAGE_DPI * scale / 72.0
+
+
+def get_size_map(graph_config):
+    scale = get_layout_scale(graph_config)
+    size_map = {name: pt2px(size, scale) for name, size in SIZE_DEF_MAP.items()}
+    size_map["line_width"] = int(round(size_map["line_width"]))
+
+    return size_map
+
+
+def get_face_map(font_config, scale=1.0):
+    face_map = {
+        name: get_font(font_config, font_type, int(round(pt2px(size, scale))))
+        for name, (font_type, size) in FACE_DEF_MAP.items()
+    }
+    log_cache_info("Font", load_font)
+
+    return face_map
+
+
+# NOTE: matplotlib はフォントサイズを 1 行の高さとしてレイアウトするので，それに合わせる
+def font_height(font):
+    return font.size
+
+
+def get_ytick_list(ylim):
+    # NOTE: 目盛りの位置は sensor_graph.py の draw_grid と同じ方法で決める
+    tick_list = matplotlib.ticker.MaxNLocator(3).tick_values(ylim[0], ylim[1])
+
+    return [tick for tick in tick_list if ylim[0] <= tick <= ylim[1]]
+
+
+def get_xtick_list(xlim, step_hour):
+    step = np.timedelta64(step_hour, "h").astype("timedelta64[ns]")
+    day = xlim[0].astype("datetime64[D]").astype("datetime64[ns]")
+    start = day + -(-(xlim[0] - day) // step) * step
+
+    return np.arange(start, xlim[1] + np.timedelta64(1, "ns"), step)
+
+
+def get_xtick_map(xlim):
+    major = get_xtick_list(xlim, 24)
+    minor = get_xtick_list(xlim, 6)
+    # NOTE: matplotlib と同様に，主目盛りと重なる補助目盛りは描かない
+    hour_list = (minor - minor.astype("datetime64[D]")) // np.timedelta64(1, "h")
+    minor = minor[hour_list != 0]
+    hour_list = hour_list[hour_list != 0]
+    day_list = (major.astype("datetime64[D]") - major.astype("datetime64[M]")).astype(
+        int
+    ) + 1
+
+    return {
+        "major": (major, ["{day}日".format(day=day) for day in day_list]),
+        "minor": (minor, ["{hour}".format(hour=hour) for hour in hour_list]),
+    }
+
+
+def time2px(value, xlim, width):
+    return (value - xlim[0]) / (xlim[1] - xlim[0]) * width
+
+
+def value2px(value, ylim, height):
+    return (1.0 - (value - ylim[0]) / (ylim[1] - ylim[0])) * height
+
+
+# NOTE: tight_layout と同じ考え方で，目盛りのラベルが収まるように余白を決める
+def get_layout(graph_config, face_map, size_map, row_list, xlim):
+    width = graph_config["WIDTH"]
+    height = graph_config["HEIGHT"]
+
+    label_width = max(
+        face_map["yaxis"].getlength(graph_config["PARAM"]["FORMAT"].format(tick))
+        for row in row_list
+        for tick in get_ytick_list(row["ylim"])
+    )
+    left = (
+        size_map["layout_pad"]
+        + label_width
+        + size_map["tick_major_size"]
+        + size_map["tick_pad"]
+    )
+    top = size_map["layout_pad"] + font_height(face_map["yaxis"]) / 2.0
+    bottom = size_map["layout_pad"] + max(
+        size_map["tick_major_size"]
+        + size_map["tick_pad"]
+        + font_height(face_map["xaxis_major"]),
+        size_map["tick_minor_size"]
+        + size_map["tick_pad"]
+        + font_height(face_map["xaxis_minor"]) * (1 + LINE_SPACING),
+    )
+
+    # NOTE: 右端の目盛りのラベルがはみ出す分だけ，右側の余白を広げる
+    right = size_map["layout_pad"]
+    major, label_list = get_xtick_map(xlim)["major"]
+    if len(major) != 0:
+        axes_width = width - left - right
+        label_right = (
+            left
+            + time2px(major[-1], xlim, axes_width)
+            + face_map["xaxis_major"].getlength(label_list[-1]) / 2.0
+        )
+        right += max(0, label_right - (width - right))
+
+    axes_height = (height - top - bottom) / (
+        len(row_list) + GRAPH_HSPACE * (len(row_list) - 1)
+    )
+
+    rect_list = []
+    for i in range(len(row_list)):
+        y0 = int(round(top + i * axes_height * (1 + GRAPH_HSPACE)))
+        y1 = int(round(top + i * axes_height * (1 + GRAPH_HSPACE) + axes_height))
+        rect_list.append((int(round(left)), y0, int(round(width - right)), y1))
+
+    return (rect_list, axes_height * (1 + GRAPH_HSPACE))
+
+
+def get_corner(x, y):
+    angle = np.arctan2(np.diff(y), np.diff(x))
+    turn = np.abs((np.diff(angle) + np.pi) % (2 * np.pi) - np.pi)
+    index = np.flatnonzero(turn > CORNER_ANGLE) + 1
+
+    return (x[index], y[index])
+
+
+def draw_plot_area(size, row, xlim, vspan_list, xtick_map, size_map):
+    width, height = size
+    x = time2px(row["data"]["time"], xlim, width)
+    y = value2px(row["data"]["value"], row["ylim"], height)
+    y_base = value2px(0, row["ylim"], height)
+
+    img = PIL.Image.new("L", size, COLOR_MAP["background"])
+    draw = PIL.ImageDraw.Draw(img)
+
+    # NOTE: 背景は白なので，半透明の塗りつぶしは合成後の色で塗る
+    draw.polygon(
+        [(x[0], y_base)] + list(zip(x, y)) + [(x[-1], y_base)],
+        fill=int(
+            COLOR_MAP["background"] * (1 - FILL_ALPHA) + COLOR_MAP["fill"] * FILL_ALPHA
+        ),
+    )
+
+    # NOTE: 黒の半透明の領域やグリッドは，画素値に係数を掛けて一度に合成する
+    col_shade = np.ones(width)
+    row_shade = np.ones(height)
+    if vspan_list is not None:
+        for vspan in vspan_list:
+            x0, x1 = time2px(
+                np.array(vspan[0:2], dtype="datetime64[ns]"), xlim, width
+            ).round()
+            col_shade[max(int(x0), 0) : max(int(x1), 0)] *= 1 - VSPAN_ALPHA[vspan[2]]
+
+    for tick_list, label_list in xtick_map.values():
+        for tick in time2px(tick_list, xlim, width).astype(int):
+            col_shade[min(max(tick, 0), width - 1)] *= 1 - GRID_ALPHA
+    for tick in get_ytick_list(row["ylim"]):
+        row_shade[
+            min(max(int(value2px(tick, row["ylim"], height)), 0), height - 1)
+        ] *= (1 - GRID_ALPHA)
+
+    shade = np.asarray(img) * row_shade[:, np.newaxis] * col_shade[np.newaxis, :]
+    img = PIL.Image.fromarray(shade.round().astype(np.uint8), "L")
+    draw = PIL.ImageDraw.Draw(img)
+
+    line_width = size_map["line_width"]
+    draw.line(list(zip(x, y)), fill=COLOR_MAP["line"], width=line_width)
+    # NOTE: joint="curve" は全ての頂点を Python で処理するため遅いので，
+    # 折れ曲がりが大きい頂点にだけ円を描いて継ぎ目を埋める
+    radius = line_width / 2.0
+    for cx, cy in zip(*get_corner(x, y)):
+        draw.ellipse(
+            (cx - radius, cy - radius, cx + radius, cy + radius),
+            fill=COLOR_MAP["line"],
+        )
+
+    marker_size = size_map["marker_size"]
+    marker_edge_width = size_map["marker_edge_width"]
+    for radius, color in [
+        ((marker_size + marker_edge_width) / 2.0, COLOR_MAP["marker_edge"]),
+        ((marker_size - marker_edge_width) / 2.0, COLOR_MAP["marker_face"]),
+    ]:
+        draw.ellipse(
+            (x[-1] - radius, y[-1] - radius, x[-1] + radius, y[-1] + radius),
+            fill=color,
+        )
+
+    return img
+
+
+def draw_text_item(img, rect, row, fmt, unit, small, face_map, size_map):
+    draw = PIL.ImageDraw.Draw(img)
+    x0, y0, x1, y1 = rect
+    width = x1 - x0
+    height = y1 - y0
+
+    if row["title"] is not None:
+        draw.text(
+            (x0 + width * 0.02, y0 + height * (1 - 0.54) - size_map["title_pad"]),
+            row["title"],
+            fill=COLOR_MAP["title"],
+            font=face_map["title"],
+            anchor="ls",
+        )
+
+    if not row["is_show_value"]:
+        return
+
+    if not row["data"]["valid"]:
+        value = "?"
+    else:
+        value = fmt.format(row["data"]["value"][-1])
+
+    draw.text(
+        (x0 + width * (0.96 - len(unit) * 0.05), y0 + height * (1 - 0.05)),
+        value,
+        fill=COLOR_MAP["value"],
+        font=face_map["value_small"] if small else face_map["value"],
+        anchor="rs",
+    )
+    draw.text(
+        (x0 + width * 0.96, y0 + height * (1 - 0.05)),
+        unit,
+        fill=COLOR_MAP["value"],
+        font=face_map["value_unit"],
+        anchor="rs",
+    )
+
+
+def draw_axis(img, rect, row, xlim, xtick_map, fmt, face_map, size_map, is_bottom):
+    draw = PIL.ImageDraw.Draw(img)
+    x0, y0, x1, y1 = rect
+    tick_major_size = size_map["tick_major_size"]
+    tick_pad = size_map["tick_pad"]
+
+    draw.rectangle((x0 - 1, y0 - 1, x1, y1), outline=COLOR_MAP["axis"])
+
+    for tick in get_ytick_list(row["ylim"]):
+        y = y0 + value2px(tick, row["ylim"], y1 - y0)
+        draw.line((x0 - 1 - tick_major_size, y, x0 - 1, y), fill=COLOR_MAP["axis"])
+        draw.text(
+            (x0 - 1 - tick_major_size - tick_pad, y),
+            fmt.format(tick),
+            fill=COLOR_MAP["axis"],
+            font=face_map["yaxis"],
+            anchor="rm",
+        )
+
+    for name, tick_size, line_offset in [
+        ("major", tick_major_size, 0),
+        ("minor", size_map["tick_minor_size"], LINE_SPACING),
+    ]:
+        tick_list, label_list = xtick_map[name]
+        font = face_map["xaxis_" + name]
+        for tick, label in zip(time2px(tick_list, xlim, x1 - x0) + x0, label_list):
+            draw.line((tick, y1, tick, y1 + tick_size), fill=COLOR_MAP["axis"])
+            if not is_bottom:
+                continue
+            # NOTE: 補助目盛りのラベルは "\n%-H" としているので，1 行下げて描く
+            draw.text(
+                (tick, y1 + tick_size + tick_pad + font.size * line_offset),
+                label,
+                fill=COLOR_MAP["axis"],
+                font=font,
+                anchor="ma",
+            )
+
+
+def draw_sensor_graph(graph_config, frame_data, font_config):
+    logging.info("draw sensor graph (raster)")
+
+    face_map = get_face_map(font_config, get_layout_scale(graph_config))
+    size_map = get_size_map(graph_config)
+    equip_list = graph_config["EQUIP_LIST"]
+
+    data_list, time_begin, valve_on_period = get_plot_data(graph_config, frame_data)
+
+    row_list = []
+    for row in range(0, len(equip_list)):
+        title, yrange, is_show_value = get_graph_row_param(
+            graph_config, equip_list[row]
+        )
+        row_list.append(
+            {
+                "title": title,
+                "ylim": yrange,
+                "is_show_value": is_show_value,
+                "data": data_list[row],
+            }
+        )
+
+    # NOTE: 全ての行で X 軸の範囲は同じ (sensor_graph.py では sharex していないが，
+    # 取得する期間が同じなので実質的に一致する)
+    xlim = [time_begin, data_list[0]["time"][-1] + np.timedelta64(1, "h")]
+    xtick_map = get_xtick_map(xlim)
+
+    rect_list, sub_plot_height = get_layout(
+        graph_config, face_map, size_map, row_list, xlim
+    )
+
+    img = PIL.Image.new(
+        "L", (graph_config["WIDTH"], graph_config["HEIGHT"]), COLOR_MAP["background"]
+    )
+
+    for i, (row, rect) in enumerate(zip(row_list, rect_list)):
+        logging.info("Plot {title}".format(title=row["title"]))
+
+        x0, y0, x1, y1 = rect
+        img.paste(
+            draw_plot_area(
+                (x1 - x0, y1 - y0),
+                row,
+                xlim,
+                valve_on_period if i != 0 else None,
+                xtick_map,
+                size_map,
+            ),
+            (x0, y0),
+        )
+        draw_text_item(
+            img,
+            rect,
+            row,
+            graph_config["PARAM"]["FORMAT"],
+            graph_config["PARAM"]["UNIT"],
+            graph_config["PARAM"]["SIZE_SMALL"],
+            face_map,
+            size_map,
+        )
+        draw_axis(
+            img,
+            rect,
+            row,
+            xlim,
+            xtick_map,
+            graph_config["PARAM"]["FORMAT"],
+            face_map,
+            size_map,
+            i == len(row_list) - 1,
+        )
+
+    return (img, sub_plot_height)
+
+
+if __name__ == "__main__":
+    import logger
+
+    from config import load_config, get_db_config
+    from frame_data import fetch_job_map
+    from sensor_graph import get_fetch_job_map
+
+    args = docopt(__doc__)
+
+    logger.init("test", logging.WARNING)
+
+    config = load_config(args["-c"])
+
+    db_config = get_db_config(config)
+    frame_data = fetch_job_map(
+        get_fetch_job_map(config["GRAPH"], db_config), db_config["concurrency"]
+    )
+
+    sensor_graph_img = draw_sensor_graph(config["GRAPH"], frame_data, config["FONT"])[0]
+
+    sensor_graph_img.save(args["-o"], "PNG")
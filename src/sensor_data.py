@@ -15,17 +15,26 @@ Options:
 from docopt import docopt
 
 import influxdb_client
+import numpy as np
+import atexit
 import datetime
+import json
 import os
+import pathlib
+import re
 import logging
+import threading
+import time
 import traceback
 
+import series_store
+
 # NOTE: データが欠損している期間も含めてデータを敷き詰めるため，
 # timedMovingAverage を使う．timedMovingAverage の計算の結果，データが後ろに
 # ずれるので，あらかじめ offset を使って前にずらしておく．
 FLUX_QUERY = """
 from(bucket: "{bucket}")
-|> range(start: -{period})
+|> range(start: {start})
     |> filter(fn:(r) => r._measurement == "{measure}")
     |> filter(fn: (r) => r.hostname == "{hostname}")
     |> filter(fn: (r) => r["_field"] == "{field}")
@@ -34,9 +43,22 @@ from(bucket: "{bucket}")
     |> timedMovingAverage(every: {every}m, period: {window}m)
 """
 
+# NOTE: 複数のホストのデータを 1 回のクエリでまとめて取得する．
+# hostname には Flux の配列表記 (["a", "b"]) を渡す．
+FLUX_MULTI_QUERY = """
+from(bucket: "{bucket}")
+|> range(start: {start})
+    |> filter(fn:(r) => r._measurement == "{measure}")
+    |> filter(fn: (r) => contains(value: r.hostname, set: {hostname}))
+    |> filter(fn: (r) => r["_field"] == "{field}")
+    |> aggregateWindow(every: {window}m, offset:-{window}m, fn: mean, createEmpty: {create_empty})
+    |> fill(usePrevious: true)
+    |> timedMovingAverage(every: {every}m, period: {window}m)
+"""
+
 FLUX_SUM_QUERY = """
 from(bucket: "{bucket}")
-    |> range(start: -{period})
+    |> range(start: {start})
     |> filter(fn:(r) => r._measurement == "{measure}")
     |> filter(fn: (r) => r.hostname == "{hostname}")
     |> filter(fn: (r) => r["_field"] == "{field}")
@@ -50,6 +72,55 @@ from(bucket: "{bucket}")
 """
 
 
+# NOTE: InfluxDBClient は内部に HTTP のコネクションプールを持っているので，
+# 接続先ごとに 1 つだけ作って使い回す．保持するコネクション数はここで制限する．
+CLIENT_POOL_SIZE = 4
+
+client_map = {}
+client_stat = {"create": 0, "reuse": 0}
+client_lock = threading.Lock()
+
+
+def get_client(db_config, token):
+    key = (db_config["url"], db_config["org"], token)
+
+    with client_lock:
+        client = client_map.get(key)
+        if client is None:
+            logging.debug(
+                "Create InfluxDB client (url: {url}, org: {org})".format(
+                    url=db_config["url"], org=db_config["org"]
+                )
+            )
+            client = influxdb_client.InfluxDBClient(
+                url=db_config["url"],
+                token=token,
+                org=db_config["org"],
+                connection_pool_maxsize=db_config.get("concurrency", CLIENT_POOL_SIZE),
+            )
+            client_map[key] = client
+            client_stat["create"] += 1
+        else:
+            client_stat["reuse"] += 1
+
+    return client
+
+
+def get_client_stat():
+    with client_lock:
+        return dict(client_stat)
+
+
+def close_client():
+    with client_lock:
+        for client in client_map.values():
+            client.close()
+        client_map.clear()
+
+
+atexit.register(close_client)
+
+
 def fetch_data_impl(
     db_config,
     template,
@@ -61,16 +132,21 @@ def fetch_data_impl(
     window,
     create_empty,
     last=False,
+    start=None,
+    stream=False,
 ):
     try:
         token = os.environ.get("INFLUXDB_TOKEN", db_config["token"])
 
+        if start is None:
+            start = "-" + period
+
         query = template.format(
             bucket=db_config["bucket"],
             measure=measure,
             hostname=hostname,
             field=field,
-            period=period,
+            start=start,
             every=every,
             window=window,
             create_empty=str(create_empty).lower(),
@@ -79,18 +155,220 @@ def fetch_data_impl(
             query += " |> last()"
 
         logging.debug("Flux query = {query}".format(query=query))
-        client = influxdb_client.InfluxDBClient(
-            url=db_config["url"], token=token, org=db_config["org"]
-        )
+        client = get_client(db_config, token)
         query_api = client.query_api()
 
-        return query_api.query(query=query)
+        logging.debug(
+            "InfluxDB client (create: {create}, reuse: {reuse})".format(
+                **get_client_stat()
+            )
+        )
+
+        if stream:
+            return query_api.query_csv(query=query)
+        else:
+            return query_api.query(query=query)
     except Exception as e:
         logging.warning(e)
         logging.warning(traceback.format_exc())
         raise
 
 
+# NOTE: Flux の duration 表記 (例: 48h, 14h53m) を timedelta に変換する
+PERIOD_UNIT_MAP = {
+    "w": "weeks",
+    "d": "days",
+    "h": "hours",
+    "m": "minutes",
+    "s": "seconds",
+}
+
+
+def parse_period(period):
+    delta = datetime.timedelta()
+    for value, unit in re.findall(r"(\d+)([wdhms])", period):
+        delta += datetime.timedelta(**{PERIOD_UNIT_MAP[unit]: int(value)})
+
+    return delta
+
+
+# NOTE: InfluxDB の時刻は UTC なので，表示用に JST にずらしておく
+LOCALTIME_OFFSET = np.timedelta64(9, "h")
+
+
+def get_now():
+    return np.datetime64(
+        datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None), "ns"
+    )
+
+
+def empty_data():
+    return {
+        "value": np.empty(0, dtype=np.float64),
+        "time": np.empty(0, dtype="datetime64[ns]"),
+        "valid": False,
+    }
+
+
+# NOTE: レコードの値と時刻をそれぞれ float64 と datetime64[ns] の配列に詰める．
+# 値が None のものは NaN になる．
+def parse_table(table):
+    record_list = table.records
+
+    value = np.array([record.get_value() for record in record_list], dtype=np.float64)
+    time = (
+        np.array(
+            [record.get_time().replace(tzinfo=None) for record in record_list],
+            dtype="datetime64[ns]",
+        )
+        + LOCALTIME_OFFSET
+    )
+
+    return {
+        "hostname": record_list[0].values.get("hostname") if record_list else None,
+        "value": value,
+        "time": time,
+    }
+
+
+# NOTE: query_csv で受け取った Annotated CSV を 1 行ずつ読み，FluxRecord を
+# 作らずに _time と _value を確保済みの配列に直接書き込む．
+def parse_csv(row_iter, capacity):
+    series_list = []
+    column_map = None
+    series = None
+
+    for row in row_iter:
+        if (len(row) == 0) or row[0].startswith("#"):
+            continue
+        if row[1] == "result":
+            column_map = {name: i for i, name in enumerate(row)}
+            continue
+
+        table = row[column_map["table"]]
+        if (series is None) or (series["table"] != table):
+            series = {
+                "table": table,
+                "hostname": (
+                    row[column_map["hostname"]] if "hostname" in column_map else None
+                ),
+                "value": np.empty(capacity, dtype=np.float64),
+                "time": np.empty(capacity, dtype="datetime64[ns]"),
+                "count": 0,
+            }
+            series_list.append(series)
+
+        i = series["count"]
+        if i == len(series["value"]):
+            series["value"] = np.resize(series["value"], i * 2)
+            series["time"] = np.resize(series["time"], i * 2)
+
+        value = row[column_map["_value"]]
+        series["value"][i] = float(value) if value != "" else np.nan
+        # NOTE: 末尾の Z を付けたままだと NumPy が警告を出すので取り除く
+        series["time"][i] = row[column_map["_time"]].rstrip("Z")
+        series["count"] += 1
+
+    return [
+        {
+            "hostname": series["hostname"],
+            "value": series["value"][: series["count"]],
+            "time": series["time"][: series["count"]] + LOCALTIME_OFFSET,
+        }
+        for series in series_list
+    ]
+
+
+def fetch_series_list(
+    db_config,
+    template,
+    measure,
+    hostname,
+    field,
+    period,
+    every,
+    window,
+    create_empty,
+    last=False,
+    start=None,
+    stream=False,
+):
+    result = fetch_data_impl(
+        db_config,
+        template,
+        measure,
+        hostname,
+        field,
+        period,
+        every,
+        window,
+        create_empty,
+        last,
+        start,
+        stream,
+    )
+
+    if stream:
+        # NOTE: 1 系列あたりのおおよそのデータ数を見積もって配列を確保しておく
+        capacity = (
+            int(parse_period(period) / datetime.timedelta(minutes=int(every))) + 16
+        )
+        return parse_csv(result, capacity)
+    else:
+        return [parse_table(table) for table in result]
+
+
+def parse_data(series, every_min, window_min, create_empty, last=False):
+    if series is None:
+        value = np.empty(0, dtype=np.float64)
+        time = np.empty(0, dtype="datetime64[ns]")
+    else:
+        value = series["value"]
+        time = series["time"]
+
+    # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
+    # だとタイミングによって，先頭に None が入る
+    is_valid = ~np.isnan(value)
+    for deleted_time in time[~is_valid]:
+        logging.debug("DELETE {datetime}".format(datetime=deleted_time))
+    value = value[is_valid]
+    time = time[is_valid]
+
+    if create_empty and not last:
+        # NOTE: aggregateWindow(createEmpty: true) と timedMovingAverage を使うと，
+        # 末尾に余分なデータが入るので取り除く
+        every_min = int(every_min)
+        window_min = int(window_min)
+        if window_min > every_min:
+            value = value[: (every_min - window_min)]
+            time = time[: (every_min - window_min)]
+
+    logging.debug("data count = {count}".format(count=len(time)))
+
+    return {"value": value, "time": time, "valid": len(time) != 0}
+
+
+# NOTE: 時刻を bucket ごとに区切り，各区間の最初，最後，最小値，最大値の点だけを
+# 残す (M4)．単純に間引くとピークが消えるし，最小値と最大値だけだと区間の間を
+# つなぐ線の傾きが変わるが，この 4 点を残せば 1 画素分の区間の折れ線は元と同じ
+# 画素を通る．区間は絶対時刻で区切り，フレームごとに残る点がずれないようにする．
+def downsample_minmax(data, bucket):
+    time = data["time"]
+    if len(time) <= 2:
+        return data
+
+    bucket_index = time.view(np.int64) // (bucket // np.timedelta64(1, "ns"))
+    first = np.concatenate([[0], np.flatnonzero(np.diff(bucket_index)) + 1])
+    last = np.concatenate([first[1:] - 1, [len(time) - 1]])
+    if len(first) * 4 >= len(time):
+        return data
+
+    order = np.lexsort((data["value"], bucket_index))
+    keep = np.unique(np.concatenate([first, last, order[first], order[last]]))
+
+    return {"value": data["value"][keep], "time": time[keep], "valid": data["valid"]}
+
+
 def fetch_data(
     db_config,
     measure,
@@ -101,12 +379,13 @@ def fetch_data(
     window_min=3,
     create_empty=True,
     last=False,
+    stream=False,
 ):
     logging.debug(
         (
             "Fetch data (measure: {measure}, host: {host}, field: {field}, "
             + "period: {period}, every: {every}min, window: {window}min, "
-            + "create_empty: {create_empty}, last: {last})"
+            + "create_empty: {create_empty}, last: {last}, stream: {stream})"
         ).format(
             measure=measure,
             host=hostname,
@@ -116,11 +395,12 @@ def fetch_data(
             window=window_min,
             create_empty=create_empty,
             last=last,
+            stream=stream,
         )
     )
 
     try:
-        table_list = fetch_data_impl(
+        series_list = fetch_series_list(
             db_config,
             FLUX_QUERY,
             measure,
@@ -131,42 +411,294 @@ def fetch_data(
             window_min,
             create_empty,
             last,
+            stream=stream,
         )
-        data = []
-        time = []
-        localtime_offset = datetime.timedelta(hours=9)
-
-        if len(table_list) != 0:
-            for record in table_list[0].records:
-                # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
-                # だとタイミングによって，先頭に None が入る
-                if record.get_value() is None:
-                    logging.debug(
-                        "DELETE {datetime}".format(
-                            datetime=record.get_time() + localtime_offset
-                        )
-                    )
-                    continue
-
-                data.append(record.get_value())
-                time.append(record.get_time() + localtime_offset)
-
-        if create_empty and not last:
-            # NOTE: aggregateWindow(createEmpty: true) と timedMovingAverage を使うと，
-            # 末尾に余分なデータが入るので取り除く
-            every_min = int(every_min)
-            window_min = int(window_min)
-            if window_min > every_min:
-                data = data[: (every_min - window_min)]
-                time = time[: (every_min - window_min)]
+        if len(series_list) != 0:
+            series = series_list[0]
+        else:
+            series = None
 
-        logging.debug("data count = {count}".format(count=len(time)))
+        return parse_data(series, every_min, window_min, create_empty, last)
+    except:
+        logging.warning(traceback.format_exc())
+
+        return empty_data()
+
+
+# NOTE: 取得したデータを系列ごとに保持しておき，2 回目以降は前回の末尾付近から
+# 後のデータのみを取得してつなぎ合わせる．移動平均を計算しているので，取得開始
+# 直後のデータは前のデータが足りずに値が不正確になる．そのため，window の
+# CACHE_OVERLAP_WINDOW 倍だけ遡って取得し，先頭の CACHE_SETTLE_WINDOW 倍の区間は
+# 捨ててキャッシュの値を使う．
+CACHE_OVERLAP_WINDOW = 3
+CACHE_SETTLE_WINDOW = 2
+
+series_cache = {}
+series_cache_lock = threading.Lock()
+
+# NOTE: 再起動直後に全系列の期間全体を取得し直さないように，キャッシュを
+# ファイルに保存しておき，最初にキャッシュを使う際に読み戻す．保存は
+# SERIES_STORE_INTERVAL_SEC ごとと終了時に行う．
+SERIES_STORE_PATH = (
+    pathlib.Path(os.path.dirname(__file__)).parent / "data" / "series_cache.bin"
+)
+SERIES_STORE_INTERVAL_SEC = 300
+
+series_store_state = {"loaded": False, "saved_at": 0.0}
+series_store_lock = threading.Lock()
+
+
+def get_cache_key(measure, hostname, field, period, every_min, window_min):
+    return (measure, hostname, field, period, int(every_min), int(window_min))
+
+
+# NOTE: 時刻は昇順に並んでいるので，保持期間より前のデータはスライスで捨てる．
+# (読み込んだ配列は mmap のビューなので，コピーせずに済む)
+def trim_data(data, period):
+    time_begin = get_now() + LOCALTIME_OFFSET - np.timedelta64(parse_period(period))
+    begin = np.searchsorted(data["time"], time_begin)
+
+    return {
+        "value": data["value"][begin:],
+        "time": data["time"][begin:],
+        "valid": len(data["time"]) != begin,
+    }
 
-        return {"value": data, "time": time, "valid": len(time) != 0}
+
+# NOTE: series_cache_lock を取得した状態で呼ぶ
+def load_series_cache():
+    if series_store_state["loaded"]:
+        return
+    series_store_state["loaded"] = True
+
+    start = time.perf_counter()
+    try:
+        series_map = series_store.load(SERIES_STORE_PATH)
     except:
         logging.warning(traceback.format_exc())
+        return
+
+    count = 0
+    for key, data in series_map.items():
+        data = trim_data(data, key[3])
+        if data["valid"] and (key not in series_cache):
+            series_cache[key] = data
+            count += 1
 
-        return {"value": [], "time": [], "valid": False}
+    logging.info(
+        "Load {count} series from {path}: {elapsed:.3f} sec".format(
+            count=count, path=SERIES_STORE_PATH, elapsed=time.perf_counter() - start
+        )
+    )
+
+
+def save_series_cache(force=False):
+    with series_cache_lock:
+        # NOTE: キャッシュを使っていない場合は，保存済みのファイルを上書きしない
+        if not series_store_state["loaded"]:
+            return
+        if (not force) and (
+            time.monotonic() - series_store_state["saved_at"]
+            < SERIES_STORE_INTERVAL_SEC
+        ):
+            return
+        series_store_state["saved_at"] = time.monotonic()
+        series_map = dict(series_cache)
+
+    start = time.perf_counter()
+    try:
+        with series_store_lock:
+            size = series_store.save(SERIES_STORE_PATH, series_map)
+    except:
+        logging.warning(traceback.format_exc())
+        return
+
+    logging.info(
+        "Save {count} series to {path} ({size:,} bytes): {elapsed:.3f} sec".format(
+            count=len(series_map),
+            path=SERIES_STORE_PATH,
+            size=size,
+            elapsed=time.perf_counter() - start,
+        )
+    )
+
+
+atexit.register(save_series_cache, True)
+
+
+def get_delta_start(cache_list, period, window_min):
+    if any(map(lambda cache: cache is None, cache_list)):
+        return None
+
+    last_time = min(map(lambda cache: cache["time"][-1], cache_list))
+    last_time -= LOCALTIME_OFFSET
+
+    if last_time < get_now() - np.timedelta64(parse_period(period)):
+        return None
+
+    return last_time - np.timedelta64(int(window_min) * CACHE_OVERLAP_WINDOW, "m")
+
+
+def merge_data(cache, data, start, period, window_min):
+    time_begin = get_now() + LOCALTIME_OFFSET - np.timedelta64(parse_period(period))
+
+    if data["valid"]:
+        settle_time = (
+            start
+            + LOCALTIME_OFFSET
+            + np.timedelta64(int(window_min) * CACHE_SETTLE_WINDOW, "m")
+        )
+    else:
+        # NOTE: 新しいデータが無い場合は，キャッシュをそのまま使う
+        settle_time = cache["time"][-1] + np.timedelta64(1, "m")
+
+    cache_index = (cache["time"] >= time_begin) & (cache["time"] < settle_time)
+    data_index = (data["time"] >= time_begin) & (data["time"] >= settle_time)
+
+    value = np.concatenate([cache["value"][cache_index], data["value"][data_index]])
+    time = np.concatenate([cache["time"][cache_index], data["time"][data_index]])
+
+    logging.debug(
+        "Merge data (cache: {cache}, fetch: {fetch}, merged: {merged})".format(
+            cache=len(cache["time"]), fetch=len(data["time"]), merged=len(time)
+        )
+    )
+
+    return {"value": value, "time": time, "valid": len(time) != 0}
+
+
+def fetch_data_multi(
+    db_config,
+    measure,
+    hostname_list,
+    field,
+    period="30h",
+    every_min=1,
+    window_min=3,
+    create_empty=True,
+    use_cache=False,
+    stream=False,
+):
+    logging.debug(
+        (
+            "Fetch data (measure: {measure}, host: [{host}], field: {field}, "
+            + "period: {period}, every: {every}min, window: {window}min, "
+            + "create_empty: {create_empty}, use_cache: {use_cache}, "
+            + "stream: {stream})"
+        ).format(
+            measure=measure,
+            host=",".join(hostname_list),
+            field=field,
+            period=period,
+            every=every_min,
+            window=window_min,
+            create_empty=create_empty,
+            use_cache=use_cache,
+            stream=stream,
+        )
+    )
+
+    key_list = [
+        get_cache_key(measure, hostname, field, period, every_min, window_min)
+        for hostname in hostname_list
+    ]
+    start = None
+    if use_cache:
+        with series_cache_lock:
+            load_series_cache()
+            cache_list = [series_cache.get(key) for key in key_list]
+        start = get_delta_start(cache_list, period, window_min)
+
+    if start is not None:
+        logging.info("Fetch delta data since {start}".format(start=start))
+
+    try:
+        series_list = fetch_series_list(
+            db_config,
+            FLUX_MULTI_QUERY,
+            measure,
+            json.dumps(list(hostname_list), ensure_ascii=False),
+            field,
+            period,
+            every_min,
+            window_min,
+            create_empty,
+            start=(
+                None if start is None else np.datetime_as_string(start, unit="s") + "Z"
+            ),
+            stream=stream,
+        )
+
+        # NOTE: テーブルは hostname ごとに分かれて返ってくるので振り分ける．
+        # fetch_data に合わせて，ホストごとに先頭のテーブルのみを使う．
+        series_map = {}
+        for series in series_list:
+            if len(series["time"]) == 0:
+                continue
+            if series["hostname"] not in series_map:
+                series_map[series["hostname"]] = series
+
+        data_list = [
+            parse_data(series_map.get(hostname), every_min, window_min, create_empty)
+            for hostname in hostname_list
+        ]
+
+        if start is not None:
+            data_list = [
+                merge_data(cache, data, start, period, window_min)
+                for cache, data in zip(cache_list, data_list)
+            ]
+
+        if use_cache:
+            with series_cache_lock:
+                for key, data in zip(key_list, data_list):
+                    if data["valid"]:
+                        series_cache[key] = data
+            save_series_cache()
+
+        return dict(zip(hostname_list, data_list))
+    except:
+        logging.warning(traceback.format_exc())
+
+        return {hostname: empty_data() for hostname in hostname_list}
+
+
+# NOTE: 各値が threshold_list のどの閾値を超えているかを求める．超えた閾値のうち，
+# threshold_list で先頭にあるものの index を返す．どの閾値も超えていない場合は
+# -1 を返す．(threshold_list は閾値が高いものから並べることを想定しているが，
+# 順序によらず同じ結果になる)
+def classify_state(value, threshold_list):
+    threshold = np.asarray(threshold_list, dtype=np.float64)
+
+    if len(threshold) == 0:
+        return np.full(len(value), -1)
+
+    # NOTE: 閾値を昇順に並べると，値が超える閾値は先頭からの連続した範囲になる．
+    # 範囲ごとに，その中で threshold_list の先頭にあるものの index を求めておく．
+    order = np.argsort(threshold, kind="stable")
+    first_index = np.minimum.accumulate(order)
+    count = np.searchsorted(threshold[order], value, side="left")
+
+    return np.where(count > 0, first_index[np.maximum(count - 1, 0)], -1)
+
+
+# NOTE: 同じ値が連続する区間を求め，各区間の開始 index，終了 index (区間に含む)，
+# 値を返す
+def get_run_list(state):
+    state = np.asarray(state)
+
+    if len(state) == 0:
+        return (
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            state,
+        )
+
+    change = np.flatnonzero(state[1:] != state[:-1]) + 1
+    start = np.concatenate([[0], change])
+    end = np.concatenate([change - 1, [len(state) - 1]])
+
+    return (start, end, state[start])
 
 
 def get_equip_on_minutes(
@@ -179,6 +711,35 @@ def get_equip_on_minutes(
     every_min=1,
     window_min=5,
     create_empty=True,
+    stream=False,
+):
+    return get_equip_on_minutes_list(
+        config,
+        measure,
+        hostname,
+        field,
+        [threshold],
+        period,
+        every_min,
+        window_min,
+        create_empty,
+        stream,
+    )[0]
+
+
+# NOTE: 閾値ごとにクエリを発行すると同じデータを何度も取得することになるので，
+# 1 回取得したデータに対して複数の閾値で判定する
+def get_equip_on_minutes_list(
+    config,
+    measure,
+    hostname,
+    field,
+    threshold_list,
+    period="30h",
+    every_min=1,
+    window_min=5,
+    create_empty=True,
+    stream=False,
 ):
     logging.info(
         (
@@ -189,7 +750,9 @@ def get_equip_on_minutes(
             type=measure,
             host=hostname,
             field=field,
-            threshold=threshold,
+            threshold="[{list_str}]".format(
+                list_str=",".join(map(str, threshold_list))
+            ),
             period=period,
             every=every_min,
             window=window_min,
@@ -198,7 +761,7 @@ def get_equip_on_minutes(
     )
 
     try:
-        table_list = fetch_data_impl(
+        series_list = fetch_series_list(
             config,
             FLUX_QUERY,
             measure,
@@ -208,34 +771,62 @@ def get_equip_on_minutes(
             every_min,
             window_min,
             create_empty,
+            stream=stream,
         )
 
-        if len(table_list) == 0:
-            return 0
+        if len(series_list) == 0:
+            return [0 for threshold in threshold_list]
 
-        count = 0
+        value = series_list[0]["value"]
 
         every_min = int(every_min)
         window_min = int(window_min)
-        record_num = len(table_list[0].records)
-        for i, record in enumerate(table_list[0].records):
-            if create_empty:
-                # NOTE: timedMovingAverage を使うと，末尾に余分なデータが入るので取り除く
-                if window_min > every_min:
-                    if i > record_num - 1 - (window_min - every_min):
-                        continue
-
-            # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
-            # だとタイミングによって，先頭に None が入る
-            if record.get_value() is None:
-                continue
-            if record.get_value() >= threshold:
-                count += 1
+        if create_empty:
+            # NOTE: timedMovingAverage を使うと，末尾に余分なデータが入るので取り除く
+            if window_min > every_min:
+                value = value[: max(len(value) - (window_min - every_min), 0)]
+
+        # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
+        # だとタイミングによって，先頭に None が入る
+        value = value[~np.isnan(value)]
 
-        return count * int(every_min)
+        count_list = []
+        for threshold in threshold_list:
+            start, end, run_state = get_run_list(value >= threshold)
+            count_list.append(int(np.sum((end - start + 1)[run_state])))
+
+        return [count * every_min for count in count_list]
     except:
         logging.warning(traceback.format_exc())
-        return 0
+        return [0 for threshold in threshold_list]
+
+
+# NOTE: 値が threshold_list のどの閾値を超えているかで区間を分け，
+# [開始時刻, 終了時刻, 閾値の index] のリストを返す．
+def get_mode_period(time, value, threshold_list):
+    last_time = time[-1]
+
+    # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
+    # だとタイミングによって，先頭に None が入る
+    is_valid = ~np.isnan(value)
+    for deleted_time in time[~is_valid]:
+        logging.debug("DELETE {datetime}".format(datetime=deleted_time))
+    value = value[is_valid]
+    time = time[is_valid]
+
+    # NOTE: 常時冷却と間欠冷却の期間を求める
+    state = classify_state(value, threshold_list)
+    start, end, run_state = get_run_list(state)
+
+    on_range = []
+    for i in np.flatnonzero(run_state != -1):
+        on_range.append([time[start[i]], time[end[i]], int(run_state[i])])
+
+    # NOTE: 最後の期間は，値が None のものも含めた末尾までとする
+    if len(run_state) != 0 and run_state[-1] != -1:
+        on_range[-1][1] = last_time
+
+    return on_range
 
 
 def get_equip_mode_period(
@@ -248,6 +839,7 @@ def get_equip_mode_period(
     every_min=10,
     window_min=10,
     create_empty=True,
+    stream=False,
 ):
     logging.info(
         (
@@ -269,7 +861,7 @@ def get_equip_mode_period(
     )
 
     try:
-        table_list = fetch_data_impl(
+        series_list = fetch_series_list(
             config,
             FLUX_QUERY,
             measure,
@@ -279,67 +871,15 @@ def get_equip_mode_period(
             every_min,
             window_min,
             create_empty,
+            stream=stream,
         )
 
-        if len(table_list) == 0:
+        if len(series_list) == 0:
             return []
 
-        # NOTE: 常時冷却と間欠冷却の期間を求める
-        on_range = []
-        state = -1
-        start_time = None
-        prev_time = None
-        localtime_offset = datetime.timedelta(hours=9)
-
-        for record in table_list[0].records:
-            # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
-            # だとタイミングによって，先頭に None が入る
-            if record.get_value() is None:
-                logging.debug(
-                    "DELETE {datetime}".format(
-                        datetime=record.get_time() + localtime_offset
-                    )
-                )
-                continue
-
-            is_idle = True
-            for i in range(len(threshold_list)):
-                if record.get_value() > threshold_list[i]:
-                    if state != i:
-                        if state != -1:
-                            on_range.append(
-                                [
-                                    start_time + localtime_offset,
-                                    prev_time + localtime_offset,
-                                    state,
-                                ]
-                            )
-                        state = i
-                        start_time = record.get_time()
-                    is_idle = False
-                    break
-            if is_idle and state != -1:
-                on_range.append(
-                    [
-                        start_time + localtime_offset,
-                        prev_time + localtime_offset,
-                        state,
-                    ]
-                )
-                state = -1
-                start_time = record.get_time()
-
-            prev_time = record.get_time()
-
-        if state != -1:
-            on_range.append(
-                [
-                    start_time + localtime_offset,
-                    table_list[0].records[-1].get_time() + localtime_offset,
-                    state,
-                ]
-            )
-        return on_range
+        return get_mode_period(
+            series_list[0]["time"], series_list[0]["value"], threshold_list
+        )
     except:
         logging.warning(traceback.format_exc())
         return []
@@ -385,7 +925,6 @@ def dump_data(data):
 
 if __name__ == "__main__":
     import logger
-    import json
 
     from config import load_config, get_db_config
 
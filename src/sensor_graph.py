@@ -1,10 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import pathlib
-import os
+"""
+センサーデータのグラフを描画します．
+
+Usage:
+  sensor_graph.py [-c CONFIG] [-o PNG_FILE]
+
+Options:
+  -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
+  -o PNG_FILE  : 生成した画像を指定されたパスに保存します．[default: test.png]
+"""
+
+from docopt import docopt
+
 import datetime
-import io
+import functools
+import hashlib
+import json
 import matplotlib
+import numpy as np
 import PIL.Image
 import logging
 
@@ -17,34 +31,93 @@ from pandas.plotting import register_matplotlib_converters
 register_matplotlib_converters()
 from matplotlib.font_manager import FontProperties
 
-from sensor_data import fetch_data
+# NOTE: スタイルの設定は描画の度に行う必要が無いので，最初に 1 回だけ行う
+plt.style.use("grayscale")
+
+from sensor_data import fetch_data_multi
 from sensor_data import get_equip_mode_period
+from sensor_data import get_now
+from sensor_data import parse_period
+from sensor_data import downsample_minmax
+from pil_util import get_font_path, log_cache_info, FONT_CACHE_SIZE
+from config import get_layout_scale
 
 IMAGE_DPI = 100.0
 
+# NOTE: fetch_data のデフォルト値と合わせる
+FETCH_EVERY_MIN = 1
+FETCH_WINDOW_MIN = 3
+
+# NOTE: GRAPH.DOWNSAMPLE で，画素数に合わせて点を減らす方法を選ぶ．
+# - none: 取得した点を全て描画する
+# - minmax: 取得後，1 画素分の区間ごとに最初，最後，最小値，最大値の点だけを描画する
+# - server: aggregateWindow の間隔を 1 画素分の時間に合わせて取得する
+DOWNSAMPLE_MODE_DEF = "none"
+
+GRAPH_HSPACE = 0.1
+VSPAN_ALPHA = [0.16, 0.07]
+
+# NOTE: 右端付近の目盛りのラベルは軸の外にはみ出すので，tight_layout で決まる
+# 右の余白はラベルの位置によって変わる．見えている目盛りの組み合わせか，
+# 右端に最も近い目盛りまでの距離 (LAYOUT_TICK_RANGE 以内の場合のみ，
+# LAYOUT_TICK_BUCKET 単位) が変わった場合は，レイアウトし直す．
+LAYOUT_TICK_RANGE_MIN = 180
+LAYOUT_TICK_BUCKET_MIN = 10
+
+# NOTE: Figure を毎フレーム作り直すのはコストが高いので，レイアウトに影響する
+# 設定が変わらない限り，同じ Figure の Artist のデータだけを更新して使い回す．
+# 大きさの異なる Kindle に表示する場合に備えて，レイアウトごとに
+# FIGURE_CACHE_SIZE 個まで (古いものから捨てる) 保持する．
+FIGURE_CACHE_SIZE = 4
+figure_cache = {}
+
+
+# NOTE: ファイルを直接指定した FontProperties を使い回すことで，font_manager による
+# フォントの検索を行わずに，読み込み済みのファイルが使われるようにする．
+# (Text に設定する際にはコピーされるので，共有しても問題ない)
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_plot_font(font_path, size):
+    logging.info("Load font: {path}".format(path=font_path))
+
+    return FontProperties(fname=font_path, size=size)
+
 
 def get_plot_font(config, font_type, size):
-    font_path = str(
-        pathlib.Path(
-            os.path.dirname(__file__), config["PATH"], config["MAP"][font_type]
-        )
-    )
+    return load_plot_font(get_font_path(config, font_type), size)
 
-    logging.info("Load font: {path}".format(path=font_path))
 
-    return FontProperties(fname=font_path, size=size)
+# NOTE: raster_graph.py でも同じフォントを使うので，種類とサイズ (pt) を共有する
+FACE_DEF_MAP = {
+    "title": ("JP_BOLD", 54),
+    "value": ("EN_MEDIUM", 100),
+    "value_small": ("EN_COND_BOLD", 80),
+    "value_unit": ("EN_MEDIUM", 30),
+    "xaxis_major": ("JP_REGULAR", 30),
+    "xaxis_minor": ("EN_MEDIUM", 24),
+    "yaxis": ("EN_MEDIUM", 16),
+}
 
 
 def get_face_map(font_config):
-    return {
-        "title": get_plot_font(font_config, "JP_BOLD", 54),
-        "value": get_plot_font(font_config, "EN_MEDIUM", 100),
-        "value_small": get_plot_font(font_config, "EN_COND_BOLD", 80),
-        "value_unit": get_plot_font(font_config, "EN_MEDIUM", 30),
-        "xaxis_major": get_plot_font(font_config, "JP_REGULAR", 30),
-        "xaxis_minor": get_plot_font(font_config, "EN_MEDIUM", 24),
-        "yaxis": get_plot_font(font_config, "EN_MEDIUM", 16),
+    face_map = {
+        name: get_plot_font(font_config, font_type, size)
+        for name, (font_type, size) in FACE_DEF_MAP.items()
     }
+    log_cache_info("Plot font", load_plot_font)
+
+    return face_map
+
+
+# NOTE: 表示範囲が変わると目盛りが作り直されることがあるので，Figure を
+# 使い回す場合はフレームごとに呼び出す
+def draw_tick_label(ax, face_map):
+    for label in ax.get_xticklabels():
+        label.set_fontproperties(face_map["xaxis_major"])
+    for label in ax.get_xminorticklabels():
+        label.set_fontproperties(face_map["xaxis_minor"])
+
+    for label in ax.get_yticklabels():
+        label.set_fontproperties(face_map["yaxis"])
 
 
 def draw_grid(ax, face_map):
@@ -56,13 +129,7 @@ def draw_grid(ax, face_map):
     ax.yaxis.set_major_locator(matplotlib.ticker.MaxNLocator(3))
     ax.yaxis.set_major_formatter(matplotlib.ticker.StrMethodFormatter("{x:,.0f}"))
 
-    for label in ax.get_xticklabels():
-        label.set_fontproperties(face_map["xaxis_major"])
-    for label in ax.get_xminorticklabels():
-        label.set_fontproperties(face_map["xaxis_minor"])
-
-    for label in ax.get_yticklabels():
-        label.set_fontproperties(face_map["yaxis"])
+    draw_tick_label(ax, face_map)
 
     ax.grid(
         axis="x", color="#000000", alpha=0.1, linestyle="-", which="both", linewidth=1
@@ -72,23 +139,23 @@ def draw_grid(ax, face_map):
     ax.label_outer()
 
 
-def draw_value(ax, data, fmt, unit, small, face_map):
+def get_value_text(data, fmt):
     if not data["valid"]:
-        value = "?"
+        return "?"
     else:
-        value = fmt.format(
-            next((item for item in reversed(data["value"]) if item is not None), None)
-        )
+        return fmt.format(data["value"][-1])
+
 
+def draw_value(ax, data, fmt, unit, small, face_map):
     if small:
         font = face_map["value_small"]
     else:
         font = face_map["value"]
 
-    ax.text(
+    value_text = ax.text(
         0.96 - len(unit) * 0.05,
         0.05,
-        value,
+        get_value_text(data, fmt),
         transform=ax.transAxes,
         horizontalalignment="right",
         color="#000000",
@@ -107,6 +174,8 @@ def draw_value(ax, data, fmt, unit, small, face_map):
         fontproperties=face_map["value_unit"],
     )
 
+    return value_text
+
 
 def plot_item(
     ax,
@@ -137,9 +206,9 @@ def plot_item(
             color="#111111",
         )
     ax.set_ylim(ylim)
-    ax.set_xlim([xbegin, x[-1] + datetime.timedelta(hours=1)])
+    ax.set_xlim([xbegin, x[-1] + np.timedelta64(1, "h")])
 
-    ax.plot(
+    line = ax.plot(
         x,
         y,
         color="#999999",
@@ -151,48 +220,207 @@ def plot_item(
         markeredgecolor="#333333",
         linewidth=5.0,
         linestyle="solid",
-    )
+    )[0]
 
-    ax.fill_between(x, y, 0, facecolor="#AAAAAA", alpha=0.5)
+    fill = ax.fill_between(x, y, 0, facecolor="#AAAAAA", alpha=0.5)
 
+    vspan_patch_list = []
     if vspan_list is not None:
-        for vspan in vspan_list:
-            ax.axvspan(
-                vspan[0], vspan[1], color="#000000", alpha=[0.16, 0.07][vspan[2]]
-            )
+        update_vspan(ax, vspan_patch_list, vspan_list)
 
     draw_grid(ax, face_map)
 
     if is_show_value:
-        draw_value(ax, data, fmt, unit, small, face_map)
+        value_text = draw_value(ax, data, fmt, unit, small, face_map)
+    else:
+        value_text = None
 
+    return {
+        "ax": ax,
+        "line": line,
+        "fill": fill,
+        "vspan_list": vspan_patch_list,
+        "value_text": value_text,
+    }
 
-def draw_sensor_graph(graph_config, db_config, font_config):
-    logging.info("draw sensor graph")
 
-    hspace = 0.1
-    face_map = get_face_map(font_config)
+# NOTE: fill_between(x, y, 0) が生成するのと同じ頂点列
+def get_fill_vertex(x, y):
+    vertex = np.zeros((len(x) * 2 + 2, 2))
+    vertex[1 : len(x) + 1, 0] = x
+    vertex[1 : len(x) + 1, 1] = y
+    vertex[0, 0] = x[0]
+    vertex[len(x) + 1, 0] = x[-1]
+    vertex[len(x) + 2 :, 0] = x[::-1]
 
-    equip_list = graph_config["EQUIP_LIST"]
-    width = graph_config["WIDTH"]
-    height = graph_config["HEIGHT"]
+    return vertex
 
-    plt.style.use("grayscale")
 
-    fig = plt.figure(facecolor="azure", edgecolor="coral", linewidth=2)
+# NOTE: axvspan が返す Patch は matplotlib のバージョンによって
+# Rectangle と Polygon のどちらかになる
+def set_vspan_range(patch, x0, x1):
+    if isinstance(patch, matplotlib.patches.Rectangle):
+        patch.set_x(x0)
+        patch.set_width(x1 - x0)
+    else:
+        patch.set_xy([[x0, 0], [x0, 1], [x1, 1], [x1, 0], [x0, 0]])
 
-    fig.set_size_inches(width / IMAGE_DPI, height / IMAGE_DPI)
 
-    cache = None
-    time_begin = datetime.datetime.now(datetime.timezone.utc)
-    for row in range(0, len(equip_list)):
-        data = fetch_data(
+def update_vspan(ax, patch_list, vspan_list):
+    for i, vspan in enumerate(vspan_list):
+        alpha = VSPAN_ALPHA[vspan[2]]
+        if i < len(patch_list):
+            x0, x1 = mdates.date2num(np.array(vspan[0:2], dtype="datetime64[ns]"))
+            set_vspan_range(patch_list[i], x0, x1)
+            patch_list[i].set_alpha(alpha)
+        else:
+            patch_list.append(
+                ax.axvspan(vspan[0], vspan[1], color="#000000", alpha=alpha)
+            )
+
+    for patch in patch_list[len(vspan_list) :]:
+        patch.remove()
+    del patch_list[len(vspan_list) :]
+
+
+def update_item(item, data, xbegin, fmt, face_map, vspan_list):
+    ax = item["ax"]
+    x = data["time"]
+    y = data["value"]
+
+    ax.set_xlim([xbegin, x[-1] + np.timedelta64(1, "h")])
+
+    item["line"].set_data(x, y)
+    item["line"].set_markevery([len(y) - 1])
+
+    item["fill"].set_verts([get_fill_vertex(mdates.date2num(x), y)])
+
+    if vspan_list is not None:
+        update_vspan(ax, item["vspan_list"], vspan_list)
+
+    draw_tick_label(ax, face_map)
+
+    if item["value_text"] is not None:
+        item["value_text"].set_text(get_value_text(data, fmt))
+
+
+def get_downsample_mode(graph_config):
+    return graph_config.get("DOWNSAMPLE", DOWNSAMPLE_MODE_DEF)
+
+
+# NOTE: 1 画素あたりの時間．実際に描画する領域は GRAPH.WIDTH より狭いので，
+# 画素の幅より少し細かい区間になり，見た目が変わることはない．
+def get_pixel_period(graph_config):
+    return np.timedelta64(
+        parse_period(graph_config["PARAM"]["PERIOD"]) / graph_config["WIDTH"]
+    )
+
+
+def get_fetch_interval(graph_config):
+    if get_downsample_mode(graph_config) != "server":
+        return (FETCH_EVERY_MIN, FETCH_WINDOW_MIN)
+
+    every_min = max(
+        FETCH_EVERY_MIN, int(get_pixel_period(graph_config) // np.timedelta64(1, "m"))
+    )
+    # NOTE: 移動平均の期間が間隔より短いと，値の無い区間ができる
+    return (every_min, max(FETCH_WINDOW_MIN, every_min))
+
+
+def get_fetch_key(graph_config, equip):
+    return (
+        equip["TYPE"],
+        equip["HOST"],
+        graph_config["PARAM"]["NAME"],
+        graph_config["PARAM"]["PERIOD"],
+    ) + get_fetch_interval(graph_config)
+
+
+# NOTE: EQUIP_LIST には同じ機器が複数回登場することがあるので，
+# 同じ条件のクエリは 1 回だけ実行して結果を使い回す．また，hostname 以外の
+# 条件が同じものは 1 回のクエリでまとめて取得する．
+def get_fetch_plan(graph_config):
+    key_list = [
+        get_fetch_key(graph_config, equip) for equip in graph_config["EQUIP_LIST"]
+    ]
+
+    fetch_plan = {}
+    for key in key_list:
+        hostname_list = fetch_plan.setdefault((key[0],) + key[2:], [])
+        if key[1] not in hostname_list:
+            hostname_list.append(key[1])
+
+    return (key_list, fetch_plan)
+
+
+def get_fetch_job_map(graph_config, db_config):
+    key_list, fetch_plan = get_fetch_plan(graph_config)
+
+    logging.info(
+        "Fetch {count} series for {row} rows by {query} queries ({saved} queries saved)".format(
+            count=sum(map(len, fetch_plan.values())),
+            row=len(key_list),
+            query=len(fetch_plan),
+            # NOTE: 以前は行ごとに 2 回ずつクエリを実行していた
+            saved=len(key_list) * 2 - len(fetch_plan),
+        )
+    )
+
+    job_map = {}
+    for query_key, hostname_list in fetch_plan.items():
+        job_map[("graph",) + query_key] = (
+            "graph ({host})".format(host=",".join(hostname_list)),
+            functools.partial(
+                fetch_data_multi,
+                db_config,
+                query_key[0],
+                hostname_list,
+                *query_key[1:],
+                use_cache=True,
+                stream=True,
+            ),
+        )
+
+    job_map[("valve",)] = (
+        "valve ({host})".format(host=graph_config["VALVE"]["HOST"]),
+        functools.partial(
+            get_equip_mode_period,
             db_config,
-            equip_list[row]["TYPE"],
-            equip_list[row]["HOST"],
-            graph_config["PARAM"]["NAME"],
+            graph_config["VALVE"]["TYPE"],
+            graph_config["VALVE"]["HOST"],
+            graph_config["VALVE"]["PARAM"],
+            [
+                # NOTE: 閾値が高いものから並べる
+                graph_config["VALVE"]["THRESHOLD"]["FULL"],
+                graph_config["VALVE"]["THRESHOLD"]["INTERM"],
+            ],
             graph_config["PARAM"]["PERIOD"],
-        )
+        ),
+    )
+
+    return job_map
+
+
+def get_graph_data(graph_config, frame_data):
+    key_list = get_fetch_plan(graph_config)[0]
+
+    return [frame_data[("graph", key[0]) + key[2:]][key[1]] for key in key_list]
+
+
+# NOTE: 取得に失敗した系列は，ダミーの値で置き換える
+def get_plot_data(graph_config, frame_data):
+    data_list = get_graph_data(graph_config, frame_data)
+
+    if get_downsample_mode(graph_config) == "minmax":
+        bucket = get_pixel_period(graph_config)
+        data_list = [
+            downsample_minmax(data, bucket) if data["valid"] else data
+            for data in data_list
+        ]
+
+    cache = None
+    time_begin = get_now()
+    for data in data_list:
         if not data["valid"]:
             continue
 
@@ -201,86 +429,235 @@ def draw_sensor_graph(graph_config, db_config, font_config):
         if cache is None:
             cache = {
                 "time": data["time"],
-                "value": [-100.0 for x in range(len(data["time"]))],
+                "value": np.full(len(data["time"]), -100.0),
                 "valid": False,
             }
 
-    valve_on_period = get_equip_mode_period(
-        db_config,
-        graph_config["VALVE"]["TYPE"],
-        graph_config["VALVE"]["HOST"],
-        graph_config["VALVE"]["PARAM"],
-        [
-            # NOTE: 閾値が高いものから並べる
-            graph_config["VALVE"]["THRESHOLD"]["FULL"],
-            graph_config["VALVE"]["THRESHOLD"]["INTERM"],
-        ],
-        graph_config["PARAM"]["PERIOD"],
+    data_list = [data if data["valid"] else cache for data in data_list]
+    valve_on_period = frame_data[("valve",)]
+
+    return (data_list, time_begin, valve_on_period)
+
+
+# NOTE: 目盛りのラベルは日付が変わると変化するので，日付もキーに含める．
+# (目盛りの位置によるレイアウトの変化は get_tick_key で扱う)
+def get_layout_key(graph_config, font_config):
+    return hashlib.sha1(
+        json.dumps(
+            [graph_config, font_config, datetime.date.today().isoformat()],
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()
+
+
+def get_graph_row_param(graph_config, equip):
+    if "LABEL" not in equip:
+        title = equip["HOST"]
+    else:
+        title = equip["LABEL"]
+
+    if "RANGE" in equip:
+        yrange = equip["RANGE"]
+    else:
+        yrange = graph_config["PARAM"]["RANGE"]
+
+    return (title, yrange, equip["SHOW_VALUE"] if "SHOW_VALUE" in equip else True)
+
+
+def create_figure(graph_config, data_list, time_begin, valve_on_period, face_map):
+    equip_list = graph_config["EQUIP_LIST"]
+    width = graph_config["WIDTH"]
+    height = graph_config["HEIGHT"]
+
+    # NOTE: 以前は savefig で書き出していたため，実際の背景と枠の色はスタイルの
+    # savefig.facecolor / savefig.edgecolor (どちらも white) だった．Figure の
+    # バッファをそのまま使うので，同じ見た目になるように色を合わせる．
+    # NOTE: フォントや線の太さは pt 単位なので，異なる大きさで描画する場合は
+    # DPI を変えることで，まとめて拡大・縮小する
+    dpi = IMAGE_DPI * get_layout_scale(graph_config)
+    fig = plt.figure(
+        facecolor=plt.rcParams["savefig.facecolor"],
+        edgecolor=plt.rcParams["savefig.edgecolor"],
+        linewidth=2,
+        dpi=dpi,
     )
 
+    fig.set_size_inches(width / dpi, height / dpi)
+
+    item_list = []
     for row in range(0, len(equip_list)):
-        data = fetch_data(
-            db_config,
-            equip_list[row]["TYPE"],
-            equip_list[row]["HOST"],
-            graph_config["PARAM"]["NAME"],
-            graph_config["PARAM"]["PERIOD"],
+        ax = fig.add_subplot(len(equip_list), 1, 1 + row)
+
+        title, yrange, is_show_value = get_graph_row_param(
+            graph_config, equip_list[row]
         )
 
-        if not data["valid"]:
-            data = cache
+        item_list.append(
+            plot_item(
+                ax,
+                title,
+                data_list[row],
+                time_begin,
+                graph_config["PARAM"]["UNIT"],
+                yrange,
+                graph_config["PARAM"]["FORMAT"],
+                graph_config["PARAM"]["UNIT"],
+                graph_config["PARAM"]["SIZE_SMALL"],
+                face_map,
+                valve_on_period if row != 0 else None,
+                is_show_value,
+            )
+        )
 
-        ax = fig.add_subplot(len(equip_list), 1, 1 + row)
+    figure = {"fig": fig, "item_list": item_list}
+    layout_figure(figure)
 
-        if "LABEL" not in equip_list[row]:
-            title = equip_list[row]["HOST"]
-        else:
-            title = equip_list[row]["LABEL"]
+    return figure
 
-        if "RANGE" in equip_list[row]:
-            yrange = equip_list[row]["RANGE"]
-        else:
-            yrange = graph_config["PARAM"]["RANGE"]
 
-        plot_item(
-            ax,
-            title,
-            data,
+def get_tick_key(ax):
+    xmin, xmax = ax.get_xlim()
+    loc_list = sorted(
+        loc
+        for loc in list(ax.xaxis.get_majorticklocs())
+        + list(ax.xaxis.get_minorticklocs())
+        if xmin <= loc <= xmax
+    )
+    if len(loc_list) == 0:
+        return ((), None)
+
+    # NOTE: 目盛りの位置は日単位の数値なので，分に直す
+    distance_min = (xmax - loc_list[-1]) * 24 * 60
+    if distance_min < LAYOUT_TICK_RANGE_MIN:
+        bucket = int(distance_min // LAYOUT_TICK_BUCKET_MIN)
+    else:
+        bucket = None
+
+    return (tuple(loc_list), bucket)
+
+
+def layout_figure(figure):
+    fig = figure["fig"]
+
+    # NOTE: tight_layout は現在の配置を基準に余白を求めるので，作り直した場合と
+    # 同じ結果になるように，初期の配置に戻してから行う
+    fig.subplots_adjust(
+        **{
+            name: plt.rcParams["figure.subplot." + name]
+            for name in ["left", "right", "bottom", "top", "hspace", "wspace"]
+        }
+    )
+    fig.tight_layout()
+    fig.subplots_adjust(hspace=GRAPH_HSPACE, wspace=0)
+
+    figure["tick_key"] = get_tick_key(figure["item_list"][-1]["ax"])
+    figure["sub_plot_height"] = None
+
+
+def update_figure(
+    figure, graph_config, data_list, time_begin, valve_on_period, face_map
+):
+    for row, item in enumerate(figure["item_list"]):
+        logging.info("Update {title}".format(title=item["ax"].get_title(loc="left")))
+
+        update_item(
+            item,
+            data_list[row],
             time_begin,
-            graph_config["PARAM"]["UNIT"],
-            yrange,
             graph_config["PARAM"]["FORMAT"],
-            graph_config["PARAM"]["UNIT"],
-            graph_config["PARAM"]["SIZE_SMALL"],
             face_map,
             valve_on_period if row != 0 else None,
-            equip_list[row]["SHOW_VALUE"] if "SHOW_VALUE" in equip_list[row] else True,
         )
 
-    fig.tight_layout()
-    plt.subplots_adjust(hspace=hspace, wspace=0)
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png", dpi=IMAGE_DPI)
+def release_figure(layout_key=None):
+    if layout_key is None:
+        key_list = list(figure_cache.keys())
+    else:
+        key_list = [layout_key]
 
-    return (
-        PIL.Image.open(buf),
-        fig.get_axes()[0].get_window_extent(fig.canvas.get_renderer()).height
-        * (1 + hspace),
-    )
+    for key in key_list:
+        figure = figure_cache.pop(key, None)
+        if figure is not None:
+            plt.close(figure["fig"])
+
+
+def draw_sensor_graph(graph_config, frame_data, font_config, reuse=True):
+    logging.info("draw sensor graph")
+
+    face_map = get_face_map(font_config)
+
+    data_list, time_begin, valve_on_period = get_plot_data(graph_config, frame_data)
+
+    layout_key = get_layout_key(graph_config, font_config)
+    if not reuse:
+        release_figure()
+
+    # NOTE: 使った順に並ぶように，一旦取り出す
+    figure = figure_cache.pop(layout_key, None)
+    try:
+        if figure is None:
+            figure = create_figure(
+                graph_config, data_list, time_begin, valve_on_period, face_map
+            )
+        else:
+            update_figure(
+                figure, graph_config, data_list, time_begin, valve_on_period, face_map
+            )
+            if get_tick_key(figure["item_list"][-1]["ax"]) != figure["tick_key"]:
+                logging.info("Update layout")
+                layout_figure(figure)
+
+        figure["fig"].canvas.draw()
+
+        # NOTE: PNG を経由せず，Agg のバッファをコピーしないでそのまま画像として扱う．
+        # Figure を使い回す場合は次の描画で内容が書き換わるので，呼び出し側は次の
+        # 描画までに使い終わること．
+        buf = figure["fig"].canvas.buffer_rgba()
+        img = PIL.Image.frombuffer(
+            "RGBA", (buf.shape[1], buf.shape[0]), buf, "raw", "RGBA", 0, 1
+        )
+    except:
+        # NOTE: 更新途中の Figure を使い回さないように，作り直させる
+        if figure is not None:
+            plt.close(figure["fig"])
+        raise
+
+    if figure["sub_plot_height"] is None:
+        fig = figure["fig"]
+        figure["sub_plot_height"] = fig.get_axes()[0].get_window_extent(
+            fig.canvas.get_renderer()
+        ).height * (1 + GRAPH_HSPACE)
+
+    if reuse:
+        figure_cache[layout_key] = figure
+        while len(figure_cache) > FIGURE_CACHE_SIZE:
+            release_figure(next(iter(figure_cache)))
+    else:
+        # NOTE: 同じプロセスで繰り返し描画するので，Figure を解放しておく
+        plt.close(figure["fig"])
+
+    return (img, figure["sub_plot_height"])
 
 
 if __name__ == "__main__":
     import logger
 
-    from config import load_config
+    from config import load_config, get_db_config
+    from frame_data import fetch_job_map
 
-    logger.init("test")
+    args = docopt(__doc__)
 
-    config = load_config()
+    logger.init("test", logging.WARNING)
 
-    sensor_graph_img = draw_sensor_graph(
-        config["GRAPH"], config["INFLUXDB"], config["FONT"]
-    )[0]
+    config = load_config(args["-c"])
+    db_config = get_db_config(config)
+
+    frame_data = fetch_job_map(
+        get_fetch_job_map(config["GRAPH"], db_config), db_config["concurrency"]
+    )
+
+    sensor_graph_img = draw_sensor_graph(config["GRAPH"], frame_data, config["FONT"])[0]
 
-    sensor_graph_img.save("test.png", "PNG")
+    sensor_graph_img.save(args["-o"], "PNG")
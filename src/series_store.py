@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+取得済みの時系列データをファイルに保存し，mmap で読み戻します．
+
+ファイルの構成は以下の通りです．(数値は全てリトルエンディアン)
+
+  ヘッダ (24 byte)
+    magic (4 byte), version (uint16), 予約 (uint16), 系列数 (uint32),
+    以降の全体の CRC32 (uint32), 索引のサイズ (uint64)
+  索引
+    系列ごとの [キー, 先頭のオフセット, 個数] を並べた JSON
+  データ
+    系列ごとに，時刻 (int64, ns) の列と値 (float64) の列を続けて並べる．
+    各列の先頭は 8 byte 境界に揃える．
+
+Usage:
+  series_store.py [-f FILE]
+
+Options:
+  -f FILE      : 内容を表示するファイル．[default: ../data/series_cache.bin]
+"""
+
+from docopt import docopt
+
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+STORE_MAGIC = b"KPSC"
+STORE_VERSION = 1
+HEADER_FORMAT = "<4sHHIIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ALIGN_SIZE = 8
+
+
+def align(size):
+    return (size + ALIGN_SIZE - 1) // ALIGN_SIZE * ALIGN_SIZE
+
+
+def save(path, series_map):
+    index_list = []
+    column_list = []
+    offset = 0
+    for key, data in series_map.items():
+        time = np.ascontiguousarray(data["time"], dtype="datetime64[ns]").view(np.int64)
+        value = np.ascontiguousarray(data["value"], dtype=np.float64)
+
+        index_list.append([list(key), offset, len(time)])
+        column_list.extend([time, value])
+        offset += time.nbytes + value.nbytes
+
+    index = json.dumps(index_list, ensure_ascii=False).encode()
+    index += b"\0" * (align(len(index)) - len(index))
+
+    crc = zlib.crc32(index)
+    for column in column_list:
+        crc = zlib.crc32(column.tobytes(), crc)
+
+    # NOTE: 書き込み途中のファイルを読まないように，一時ファイルに書いてから置き換える
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(
+            struct.pack(
+                HEADER_FORMAT,
+                STORE_MAGIC,
+                STORE_VERSION,
+                0,
+                len(index_list),
+                crc,
+                len(index),
+            )
+        )
+        f.write(index)
+        for column in column_list:
+            f.write(column.tobytes())
+    os.replace(tmp_path, path)
+
+    return HEADER_SIZE + len(index) + offset
+
+
+# NOTE: 各系列の配列は mmap 上のビューとして返すので，読み込み時にコピーは
+# 発生しない．ビューが参照されている間は mmap も開いたままになる．
+# ファイルが無い，あるいは壊れている場合は空の辞書を返す．
+def load(path):
+    if not path.exists():
+        return {}
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER_SIZE:
+            logging.warning("Series store is too short: {path}".format(path=path))
+            return {}
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, _, count, crc, index_size = struct.unpack_from(HEADER_FORMAT, buf)
+    if magic != STORE_MAGIC:
+        logging.warning("Series store has unknown format: {path}".format(path=path))
+        return {}
+    if version != STORE_VERSION:
+        logging.warning(
+            "Series store version mismatch (file: {file}, expected: {expected})".format(
+                file=version, expected=STORE_VERSION
+            )
+        )
+        return {}
+    if zlib.crc32(memoryview(buf)[HEADER_SIZE:]) != crc:
+        logging.warning("Series store is corrupted: {path}".format(path=path))
+        return {}
+
+    try:
+        index_list = json.loads(
+            buf[HEADER_SIZE : HEADER_SIZE + index_size].rstrip(b"\0").decode()
+        )
+        data_offset = HEADER_SIZE + index_size
+
+        series_map = {}
+        for key, offset, size in index_list[:count]:
+            offset += data_offset
+            time = np.frombuffer(buf, dtype=np.int64, count=size, offset=offset)
+            value = np.frombuffer(
+                buf, dtype=np.float64, count=size, offset=offset + time.nbytes
+            )
+            series_map[tuple(key)] = {
+                "value": value,
+                "time": time.view("datetime64[ns]"),
+                "valid": size != 0,
+            }
+    except:
+        logging.warning("Series store has broken index: {path}".format(path=path))
+        return {}
+
+    return series_map
+
+
+if __name__ == "__main__":
+    import pathlib
+    import logger
+
+    args = docopt(__doc__)
+
+    logger.init("test", level=logging.INFO)
+
+    path = pathlib.Path(args["-f"])
+    for key, data in load(path).items():
+        logging.info(
+            "{key}: {count} points ({begin} - {end})".format(
+                key=key,
+                count=len(data["time"]),
+                begin=data["time"][0] if data["valid"] else "-",
+                end=data["time"][-1] if data["valid"] else "-",
+            )
+        )
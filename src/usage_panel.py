@@ -6,36 +6,56 @@ import PIL.ImageDraw
 import PIL.ImageFont
 import logging
 import datetime
+import functools
+import hashlib
+import json
 
-from sensor_data import get_equip_on_minutes
-from pil_util import draw_text, text_size, get_font, load_image
+from sensor_data import get_equip_on_minutes_list
+from pil_util import draw_text, text_size, get_font, load_icon
+from pil_util import load_font, log_cache_info
+from config import get_layout_scale
 
+# NOTE: 使用時間は右端からこの幅だけ空けて右寄せで描画する
+USAGE_RIGHT_MARGIN = 92
 
-def get_face_map(font_config):
-    return {
+
+# NOTE: 位置や大きさ (px) は PANEL.DEVICE の大きさ向けの値なので，倍率を掛けて使う
+def scale_px(value, scale):
+    return int(round(value * scale))
+
+
+def get_face_map(font_config, scale=1.0):
+    def font(font_type, size):
+        return get_font(font_config, font_type, scale_px(size, scale))
+
+    face_map = {
         "usage": {
             "work": {
-                "label": get_font(font_config, "JP_REGULAR", 50),
-                "value": get_font(font_config, "JP_BOLD", 150),
-                "unit": get_font(font_config, "JP_REGULAR", 60),
+                "label": font("JP_REGULAR", 50),
+                "value": font("JP_BOLD", 150),
+                "unit": font("JP_REGULAR", 60),
             },
             "leave": {
-                "label": get_font(font_config, "JP_REGULAR", 40),
-                "value": get_font(font_config, "JP_REGULAR", 40),
-                "unit": get_font(font_config, "JP_REGULAR", 30),
+                "label": font("JP_REGULAR", 40),
+                "value": font("JP_REGULAR", 40),
+                "unit": font("JP_REGULAR", 30),
             },
         },
         "date": {
-            "value": get_font(font_config, "EN_MEDIUM", 36),
+            "value": font("EN_MEDIUM", 36),
         },
     }
+    log_cache_info("Font", load_font)
+
+    return face_map
 
 
 def draw_icon(img, config, name, pos_x, pos_y):
-    img.paste(load_image(config[name]), (pos_x, pos_y))
+    img.paste(load_icon(config[name], img.mode), (pos_x, pos_y))
 
 
-def draw_time(img, x, y, label, minutes, suffix, face):
+def draw_time(img, x, y, label, minutes, suffix, face, scale=1.0):
+    space = scale_px(10, scale)
     value_height = face["value"].getsize("0")[1]
     unit_dy = value_height - face["unit"].getsize("0")[1]
     label_dy = value_height - face["label"].getsize("0")[1]
@@ -62,57 +82,56 @@ def draw_time(img, x, y, label, minutes, suffix, face):
             "#000",
             False,
         )
-        x -= text_size(face["unit"], "分")[0] + 10
+        x -= text_size(face["unit"], "分")[0] + space
 
         if minutes < 10:
             minute_text = "{minute:d}".format(minute=minutes)
         else:
             minute_text = "{minute:02d}".format(minute=minutes % 60)
         draw_text(img, minute_text, [x, y], face["value"], "right", "#000", False)
-        x -= text_size(face["value"], minute_text)[0] + 10
+        x -= text_size(face["value"], minute_text)[0] + space
 
     if minutes >= 60:
         draw_text(img, "時間", [x, y + unit_dy], face["unit"], "right", "#000", False)
-        x -= text_size(face["unit"], "時間")[0] + 10
+        x -= text_size(face["unit"], "時間")[0] + space
 
         hour_text = "{hour:.0f}".format(hour=minutes / 60)
         draw_text(img, hour_text, [x, y], face["value"], "right", "#000", False)
-        x -= text_size(face["value"], hour_text)[0] + 10
+        x -= text_size(face["value"], hour_text)[0] + space
 
     draw_text(img, label, [x, y + label_dy], face["label"], "right", "#000", False)
 
     return value_height
 
 
-def draw_usage(
-    img,
-    panel_config,
-    db_config,
-    equip_list,
-    offset_y,
-    sub_plot_height,
-    face,
-    icon_config,
-):
-    now = datetime.datetime.now()
+# NOTE: now は表示する時刻 (ローカル時刻)．先行して描画する場合も，表示する時点の
+# 値になるように呼び出し側から渡す．
+def get_fetch_job_map(panel_config, db_config, now=None):
+    if now is None:
+        now = datetime.datetime.now()
     period = "{hour}h{minute}m".format(hour=now.hour, minute=now.minute)
 
-    work_minutes = get_equip_on_minutes(
-        db_config,
-        panel_config["TARGET"]["TYPE"],
-        panel_config["TARGET"]["HOST"],
-        panel_config["TARGET"]["PARAM"],
-        panel_config["TARGET"]["THRESHOLD"]["WORK"],
-        period,
-    )
-    wake_minutes = get_equip_on_minutes(
-        db_config,
-        panel_config["TARGET"]["TYPE"],
-        panel_config["TARGET"]["HOST"],
-        panel_config["TARGET"]["PARAM"],
-        panel_config["TARGET"]["THRESHOLD"]["WAKE"],
-        period,
-    )
+    return {
+        ("usage",): (
+            "usage ({host})".format(host=panel_config["TARGET"]["HOST"]),
+            functools.partial(
+                get_equip_on_minutes_list,
+                db_config,
+                panel_config["TARGET"]["TYPE"],
+                panel_config["TARGET"]["HOST"],
+                panel_config["TARGET"]["PARAM"],
+                [
+                    panel_config["TARGET"]["THRESHOLD"]["WORK"],
+                    panel_config["TARGET"]["THRESHOLD"]["WAKE"],
+                ],
+                period,
+            ),
+        )
+    }
+
+
+def draw_usage(img, panel_config, frame_data, offset_y, face):
+    work_minutes, wake_minutes = frame_data[("usage",)]
     leave_minutes = max(wake_minutes - work_minutes - 5, 0)
 
     logging.info(
@@ -121,62 +140,94 @@ def draw_usage(
         )
     )
 
-    x = 980
-    y = offset_y + 30
+    scale = get_layout_scale(panel_config)
+    x = panel_config["WIDTH"] - scale_px(USAGE_RIGHT_MARGIN, scale)
+    y = offset_y + scale_px(30, scale)
 
     if leave_minutes > 5:
-        y += draw_time(img, x, y, "本日", work_minutes, None, face["work"])
-        y += 15
-        draw_time(img, x, y, "(放置 ", leave_minutes, ")", face["leave"])
+        y += draw_time(img, x, y, "本日", work_minutes, None, face["work"], scale)
+        y += scale_px(15, scale)
+        draw_time(img, x, y, "(放置 ", leave_minutes, ")", face["leave"], scale)
     else:
-        y += 45
-        draw_time(img, x, y, "本日", work_minutes, None, face["work"])
+        y += scale_px(45, scale)
+        draw_time(img, x, y, "本日", work_minutes, None, face["work"], scale)
 
-    y = offset_y + 130
-    for i in range(len(equip_list)):
-        draw_icon(img, icon_config, equip_list[i]["ICON"], 110, int(y))
-        y += sub_plot_height
 
-
-def draw_datetime(img, panel_config, face):
-    now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9), "JST"))
+def draw_datetime(img, panel_config, face, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    now = now.astimezone(datetime.timezone(datetime.timedelta(hours=9), "JST"))
+    scale = get_layout_scale(panel_config)
 
     draw_text(
         img,
         now.strftime("%Y/%-m/%-d %H:%M"),
-        [panel_config["WIDTH"] - 20, 15],
+        [panel_config["WIDTH"] - scale_px(20, scale), scale_px(15, scale)],
         face["value"],
         "right",
         color="#333",
     )
 
 
-def draw_usage_panel(
-    panel_config,
-    db_config,
-    equip_list,
-    offset_y,
-    sub_plot_height,
-    font_config,
-    icon_config,
+# NOTE: アイコンなど，データによらず変化しない部分は下地の画像に描画しておき，
+# レイアウトや設定が変わらない限り，各フレームはその複製に描画する
+# (大きさの異なる Kindle に表示する場合に備えて，レイアウトごとに保持する)
+panel_base_map = {}
+
+
+def draw_usage_panel_base(
+    panel_config, equip_list, offset_y, sub_plot_height, icon_config
 ):
-    logging.info("draw usage panel")
+    key = hashlib.sha1(
+        json.dumps(
+            [
+                panel_config["WIDTH"],
+                panel_config["HEIGHT"],
+                get_layout_scale(panel_config),
+                [equip["ICON"] for equip in equip_list],
+                offset_y,
+                sub_plot_height,
+                icon_config,
+            ],
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+    icon_list = [load_icon(icon_config[equip["ICON"]]) for equip in equip_list]
+
+    # NOTE: アイコンのファイルが更新されると load_icon が別の画像を返すので，
+    # その場合も描画し直す
+    panel_base = panel_base_map.get(key)
+    if (panel_base is not None) and all(
+        icon is cache for icon, cache in zip(icon_list, panel_base["icon_list"])
+    ):
+        return panel_base["img"]
+
+    logging.info("draw usage panel base")
 
     img = PIL.Image.new(
         "RGBA", (panel_config["WIDTH"], panel_config["HEIGHT"]), (255, 255, 255, 0)
     )
-    face_map = get_face_map(font_config)
 
-    draw_usage(
-        img,
-        panel_config,
-        db_config,
-        equip_list,
-        offset_y,
-        sub_plot_height,
-        face_map["usage"],
-        icon_config,
-    )
-    draw_datetime(img, panel_config, face_map["date"])
+    scale = get_layout_scale(panel_config)
+    y = offset_y + scale_px(130, scale)
+    for i in range(len(equip_list)):
+        draw_icon(img, icon_config, equip_list[i]["ICON"], scale_px(110, scale), int(y))
+        y += sub_plot_height
+
+    panel_base_map[key] = {"icon_list": icon_list, "img": img}
+
+    return img
+
+
+def draw_usage_panel(
+    panel_config, frame_data, offset_y, font_config, base_img, now=None
+):
+    logging.info("draw usage panel")
+
+    img = base_img.copy()
+    face_map = get_face_map(font_config, get_layout_scale(panel_config))
+
+    draw_usage(img, panel_config, frame_data, offset_y, face_map["usage"])
+    draw_datetime(img, panel_config, face_map["date"], now)
 
     return img
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent / "src"))
+
+from sensor_data import (  # noqa: E402
+    classify_state,
+    get_run_list,
+    get_mode_period,
+    downsample_minmax,
+)
+
+
+# NOTE: ベクトル化する前の get_equip_mode_period の実装
+def mode_period_loop(time, value, threshold_list):
+    last_time = time[-1]
+
+    is_valid = ~np.isnan(value)
+    value = value[is_valid]
+    time = time[is_valid]
+
+    on_range = []
+    state = -1
+    start_time = None
+    prev_time = None
+
+    for j in range(len(value)):
+        is_idle = True
+        for i in range(len(threshold_list)):
+            if value[j] > threshold_list[i]:
+                if state != i:
+                    if state != -1:
+                        on_range.append([start_time, prev_time, state])
+                    state = i
+                    start_time = time[j]
+                is_idle = False
+                break
+        if is_idle and state != -1:
+            on_range.append([start_time, prev_time, state])
+            state = -1
+            start_time = time[j]
+
+        prev_time = time[j]
+
+    if state != -1:
+        on_range.append([start_time, last_time, state])
+    return on_range
+
+
+def classify_loop(value, threshold_list):
+    state_list = []
+    for v in value:
+        state = -1
+        for i in range(len(threshold_list)):
+            if v > threshold_list[i]:
+                state = i
+                break
+        state_list.append(state)
+
+    return np.array(state_list, dtype=np.int64)
+
+
+def gen_series(rng, count, nan_ratio=0.1):
+    time = np.datetime64("2024-01-01T00:00", "ns") + np.arange(count) * np.timedelta64(
+        1, "m"
+    )
+    # NOTE: 同じ値が続く区間ができるように，整数に丸める
+    value = np.round(rng.uniform(0, 6, count))
+    value[rng.random(count) < nan_ratio] = np.nan
+
+    return (time, value)
+
+
+def gen_threshold_list(rng):
+    return list(np.round(rng.uniform(0, 6, rng.integers(0, 4))))
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_classify_state(seed):
+    rng = np.random.default_rng(seed)
+    value = np.round(rng.uniform(0, 6, 100))
+    threshold_list = gen_threshold_list(rng)
+
+    np.testing.assert_array_equal(
+        classify_state(value, threshold_list), classify_loop(value, threshold_list)
+    )
+
+
+def test_classify_state_order():
+    # NOTE: 閾値の並び順によらず，先頭にある閾値が優先される
+    assert list(classify_state(np.array([6.0, 3.0, 1.0]), [2.0, 5.0])) == [0, 0, -1]
+    assert list(classify_state(np.array([6.0, 3.0, 1.0]), [5.0, 2.0])) == [0, 1, -1]
+    # NOTE: 閾値と同じ値は超えていない
+    assert list(classify_state(np.array([5.0, 2.0]), [5.0, 2.0])) == [1, -1]
+
+
+def test_get_run_list():
+    start, end, state = get_run_list(np.array([1, 1, 2, 2, 2, 1, -1]))
+
+    assert list(start) == [0, 2, 5, 6]
+    assert list(end) == [1, 4, 5, 6]
+    assert list(state) == [1, 2, 1, -1]
+
+    start, end, state = get_run_list(np.array([], dtype=np.int64))
+    assert len(start) == len(end) == len(state) == 0
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_get_run_list_count(seed):
+    rng = np.random.default_rng(seed)
+    value = rng.uniform(0, 6, rng.integers(0, 100))
+    threshold = rng.uniform(0, 6)
+
+    start, end, state = get_run_list(value >= threshold)
+
+    assert int(np.sum((end - start + 1)[state])) == np.count_nonzero(value >= threshold)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_get_mode_period(seed):
+    rng = np.random.default_rng(seed)
+    time, value = gen_series(rng, int(rng.integers(1, 200)))
+    threshold_list = gen_threshold_list(rng)
+
+    assert get_mode_period(time, value, threshold_list) == mode_period_loop(
+        time, value, threshold_list
+    )
+
+
+def test_get_mode_period_last_nan():
+    # NOTE: 最後の期間は，値が NaN のものも含めた末尾までとする
+    time, value = gen_series(np.random.default_rng(0), 5, 0)
+    value[:] = [0.0, 1.0, 1.0, np.nan, np.nan]
+
+    assert get_mode_period(time, value, [0.5]) == [[time[1], time[4], 0]]
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_downsample_minmax(seed):
+    rng = np.random.default_rng(seed)
+    time, value = gen_series(rng, 500, 0)
+    value += rng.uniform(0, 1, len(value))
+    bucket = np.timedelta64(int(rng.integers(5, 30)), "m")
+
+    data = downsample_minmax({"time": time, "value": value, "valid": True}, bucket)
+
+    # NOTE: 区間ごとに最初，最後，最小値，最大値の点が残っていること
+    assert np.all(np.diff(data["time"]) > np.timedelta64(0))
+    bucket_index = time.view(np.int64) // (bucket // np.timedelta64(1, "ns"))
+    for index in np.unique(bucket_index):
+        is_bucket = bucket_index == index
+        kept = np.isin(time[is_bucket], data["time"])
+        assert kept[0] and kept[-1]
+        assert np.min(value[is_bucket]) in data["value"]
+        assert np.max(value[is_bucket]) in data["value"]
+        assert np.count_nonzero(kept) <= 4